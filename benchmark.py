@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the hot paths: mining, signing, verification, serialization,
+chain validation and the mempool.
+
+    python benchmark.py --output baseline.json
+    python benchmark.py --compare baseline.json
+
+With --compare the exit code is 1 if any benchmark got slower than the threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+
+from block import Block
+from blockchain import Blockchain
+from codec import decode_block, encode_block
+from data_manipulation import fromJSON
+from keys import KeyManager
+from mempool import Mempool
+from signature_cache import signature_cache
+from transaction import Transaction
+
+DIFFICULTIES = (1, 2, 3, 4)
+CHAIN_SIZES = (1000, 10000, 100000)
+DISTINCT_TRANSACTIONS = 200  # Signed transactions cycled through benchmark chains
+
+
+def measure(function: Callable, ops: int = 1, repeat: int = 3, setup: Callable = None) -> Dict[str, float]:
+    """
+    Returns the best time of `repeat` runs of a function
+    :param function: Function to time
+    :param ops: Number of operations done by one call, for per operation times
+    :param repeat: Number of timed runs
+    :param setup: Function called before every run, not timed
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    return {"seconds": best, "ops": ops, "per_op": best / ops}
+
+
+def signed_transactions(count: int) -> List[Transaction]:
+    """
+    Returns distinct transactions signed with a throwaway key
+    :param count: Number of transactions
+    """
+    key = KeyManager.generate_private_key()
+    transactions = []
+    for i in range(count):
+        transaction = Transaction(key.public_key(), "1.0", f"{i:064x}", f"firmware-{i}.bin")
+        transaction.sign(key)
+        transactions.append(transaction)
+    return transactions
+
+
+def bench_pow(blockchain: Blockchain, repeat: int) -> Dict[str, Dict]:
+    """
+    Blockchain.proof_of_work at several difficulties.
+    Averaged over a few blocks, as the number of attempts varies a lot.
+    """
+    results = {}
+    for difficulty in DIFFICULTIES:
+        blocks = [Block(1, [], datetime(2020, 1, 1) + timedelta(seconds=i), "0" * 64)
+                  for i in range(8)]
+
+        def run():
+            for block in blocks:
+                block.nonce = 0
+                blockchain.proof_of_work(block)
+        blockchain.DIFFICULTY = difficulty
+        results[f"pow.difficulty_{difficulty}"] = measure(run, len(blocks), repeat)
+    del blockchain.DIFFICULTY
+    return results
+
+
+def bench_signatures(transactions: List[Transaction], repeat: int) -> Dict[str, Dict]:
+    """
+    Transaction.sign and verify, with and without the signature cache
+    """
+    key = KeyManager.generate_private_key()
+    # Signed copies, the originals are shared with other benchmarks
+    sample = [Transaction(key.public_key(), t.version, t.file_hash, t.filename) for t in transactions[:50]]
+    return {
+        "transaction.sign": measure(lambda: [t.sign(key) for t in sample], len(sample), repeat),
+        "transaction.verify": measure(lambda: [t._verify_signature() for t in transactions[50:100]],
+                                      50, repeat),
+        "transaction.verify_cached": measure(lambda: [t.verify() for t in transactions[50:100]],
+                                             50, repeat, setup=lambda: [t.verify() for t in transactions[50:100]]),
+    }
+
+
+def bench_serialization(transactions: List[Transaction], repeat: int) -> Dict[str, Dict]:
+    """
+    JSON and msgpack round trips of blocks, bypassing cached encodings
+    """
+    blocks = []
+    for i in range(100):
+        block = Block(i, transactions[i % 10 * 10:i % 10 * 10 + 10], datetime(2020, 1, 1), "0" * 64)
+        blocks.append(block)
+    encoded_json = [b.toJSON() for b in blocks]
+    encoded_msgpack = [encode_block(b) for b in blocks]
+
+    def drop_encodings():
+        for block in blocks:
+            block.invalidate_hash()
+
+    return {
+        "block.to_json": measure(lambda: [b.toJSON() for b in blocks], len(blocks), repeat,
+                                 setup=drop_encodings),
+        "block.from_json": measure(lambda: [fromJSON(b) for b in encoded_json], len(blocks), repeat),
+        "block.to_msgpack": measure(lambda: [encode_block(b) for b in blocks], len(blocks), repeat,
+                                    setup=drop_encodings),
+        "block.from_msgpack": measure(lambda: [decode_block(b) for b in encoded_msgpack],
+                                      len(blocks), repeat),
+    }
+
+
+def build_chain(size: int, transactions: List[Transaction]) -> Blockchain:
+    """
+    Returns in-memory blockchain with `size` blocks of one transaction each.
+    Difficulty is 0, so building measures nothing but appending.
+    """
+    blockchain = Blockchain()
+    blockchain.DIFFICULTY = 0
+    start = datetime(2020, 1, 1)
+    while len(blockchain.chain) < size:
+        height = len(blockchain.chain)
+        block = Block(height, [transactions[height % len(transactions)]],
+                      start + timedelta(seconds=height), blockchain.last_hash)
+        blockchain.append_block(block)
+    return blockchain
+
+
+def bench_chain(sizes: List[int], transactions: List[Transaction], repeat: int) -> Dict[str, Dict]:
+    """
+    verify_chain and blockchain_root at several chain lengths.
+    Blocks reuse DISTINCT_TRANSACTIONS signatures, so full verification measures
+    chain traversal rather than RSA, which transaction.verify covers.
+    """
+    results = {}
+    for size in sizes:
+        blockchain = build_chain(size, transactions)
+
+        def reset():
+            blockchain.reset_checkpoint()
+            signature_cache.clear()
+
+        results[f"chain.verify_full.{size}"] = measure(blockchain.verify_chain, size, repeat, setup=reset)
+        blockchain.verify_chain()
+
+        def append():
+            height = len(blockchain.chain)
+            blockchain.append_block(Block(height, [transactions[height % len(transactions)]],
+                                          datetime(2021, 1, 1), blockchain.last_hash))
+
+        # One new block on top of a verified chain
+        results[f"chain.verify_incremental.{size}"] = measure(blockchain.verify_chain, 1, repeat,
+                                                              setup=append)
+        results[f"chain.root.{size}"] = measure(lambda: blockchain.blockchain_root, 1, repeat)
+        hashes = [blockchain.block_hash(i) for i in range(size)]
+        results[f"chain.root_rebuild.{size}"] = measure(
+            lambda: blockchain.accumulator.rebuild(hashes), size, repeat)
+        blockchain.close()
+    return results
+
+
+def bench_mempool(count: int, repeat: int) -> Dict[str, Dict]:
+    """
+    Mempool insertion, rejection of duplicates and removal of mined transactions
+    """
+    key = KeyManager.generate_private_key().public_key()
+    transactions = [Transaction(key, "1.0", f"{i:064x}", "f") for i in range(count)]
+    for transaction in transactions:
+        transaction.digest  # Warm serialized key cache
+    mempool = Mempool(max_count=count)
+
+    def fill():
+        for transaction in transactions:
+            mempool.add(transaction)
+
+    return {
+        "mempool.add": measure(fill, count, repeat, setup=mempool.clear),
+        "mempool.add_duplicate": measure(fill, count, repeat),
+        "mempool.remove_many": measure(lambda: mempool.remove_many(transactions), count, repeat,
+                                       setup=fill),
+    }
+
+
+def run(sizes: List[int], only: List[str], repeat: int) -> Dict:
+    """
+    Runs selected benchmark groups and returns results with environment information
+    :param sizes: Chain lengths for the chain benchmarks
+    :param only: Names of groups to run, all if empty
+    :param repeat: Number of timed runs of each benchmark
+    """
+    transactions = signed_transactions(DISTINCT_TRANSACTIONS)
+    groups = {
+        "pow": lambda: bench_pow(blockchain, repeat),
+        "signatures": lambda: bench_signatures(transactions, repeat),
+        "serialization": lambda: bench_serialization(transactions, repeat),
+        "chain": lambda: bench_chain(sizes, transactions, repeat),
+        "mempool": lambda: bench_mempool(10000, repeat),
+    }
+    blockchain = Blockchain()
+    results = {}
+    for name, group in groups.items():
+        if only and name not in only:
+            continue
+        print(f"Running {name}...", file=sys.stderr)
+        results.update(group())
+    blockchain.close()
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "date": datetime.now().isoformat(timespec="seconds"),
+        },
+        "results": results
+    }
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """
+    Prints per operation times against a baseline and returns names of regressed benchmarks
+    :param results: Current results
+    :param baseline: Saved results
+    :param threshold: Allowed slowdown, 0.2 means 20%
+    """
+    regressions = []
+    for name, result in results["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            print(f"{name:40} {result['per_op'] * 1e6:12.2f} us   (new)")
+            continue
+        ratio = result["per_op"] / old["per_op"] if old["per_op"] else float("inf")
+        mark = ""
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            mark = "  REGRESSION"
+        print(f"{name:40} {result['per_op'] * 1e6:12.2f} us {ratio:7.2f}x{mark}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FirmwareChain benchmarks")
+    parser.add_argument("--output", help="Save results as JSON to this file")
+    parser.add_argument("--compare", help="Baseline JSON file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Allowed slowdown against the baseline, default 0.2")
+    parser.add_argument("--sizes", default=",".join(map(str, CHAIN_SIZES)),
+                        help="Comma separated chain lengths")
+    parser.add_argument("--only", default="",
+                        help="Comma separated groups: pow, signatures, serialization, chain, mempool")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs of each benchmark")
+    parser.add_argument("--quick", action="store_true", help="Only 1000 block chains, one run")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    repeat = args.repeat
+    if args.quick:
+        sizes, repeat = [1000], 1
+    only = [g for g in args.only.split(",") if g]
+
+    results = run(sizes, only, repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+    elif not args.output:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
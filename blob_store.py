@@ -0,0 +1,342 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+from firmware import file_key
+
+CHUNK_SIZE = 1024 * 1024  # Bytes per chunk of a firmware file
+_HASH = re.compile(r"[0-9a-f]{64}")
+
+
+def is_hash(value) -> bool:
+    """
+    Returns True if value is a SHA256 hex digest, the only names allowed in the store.
+    Hashes come from peers, anything else could point outside the store directory.
+    :param value: Value to check
+    """
+    return isinstance(value, str) and _HASH.fullmatch(value) is not None
+
+
+def manifest_hash(manifest: Dict) -> str:
+    """
+    Returns hash identifying a manifest, computed from its canonical JSON
+    :param manifest: Manifest dictionary
+    """
+    return hashlib.sha256(encode_manifest(manifest)).hexdigest()
+
+
+def encode_manifest(manifest: Dict) -> bytes:
+    """
+    Returns canonical JSON of a manifest
+    :param manifest: Manifest dictionary
+    """
+    return json.dumps(manifest, sort_keys=True, separators=(",", ":")).encode()
+
+
+class BlobStore:
+    """
+    Content-addressed store of firmware files.
+    Files are split into fixed size chunks stored under their SHA256, so chunks shared
+    by several versions are stored once. A manifest lists the chunks of a file and
+    is referenced by transactions with its own hash.
+    """
+    CACHE_SIZE = 1024  # Number of remembered manifests of added files
+
+    def __init__(self, path: str, chunk_size: int = CHUNK_SIZE):
+        """
+        BlobStore class constructor
+        :param path: Directory with chunks and manifests, created if missing
+        :param chunk_size: Bytes per chunk of newly added files
+        """
+
+        self.path = path
+        self.chunk_size = chunk_size
+        self.deduplicated = 0  # Chunks not written because they were already stored
+        # (path, size, mtime) -> manifest hash, unchanged files aren't read again
+        self._added = OrderedDict()  # type: OrderedDict[Tuple[str, int, int], str]
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(path, "chunks"), exist_ok=True)
+        os.makedirs(os.path.join(path, "manifests"), exist_ok=True)
+
+    def _chunk_path(self, chunk_hash: str) -> str:
+        return os.path.join(self.path, "chunks", chunk_hash[:2], chunk_hash)
+
+    def _manifest_path(self, m_hash: str) -> str:
+        return os.path.join(self.path, "manifests", m_hash + ".json")
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        """
+        Writes file atomically, readers never see a partial chunk
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def has_chunk(self, chunk_hash: str) -> bool:
+        """
+        Returns True if chunk is stored
+        :param chunk_hash: SHA256 of the chunk
+        """
+        return is_hash(chunk_hash) and os.path.exists(self._chunk_path(chunk_hash))
+
+    def get_chunk(self, chunk_hash: str) -> bytes:
+        """
+        Returns chunk data or None if it isn't stored
+        :param chunk_hash: SHA256 of the chunk
+        """
+        if not is_hash(chunk_hash):
+            return None
+        try:
+            with open(self._chunk_path(chunk_hash), "rb") as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def put_chunk(self, chunk_hash: str, data: bytes) -> bool:
+        """
+        Stores chunk, returns False if data doesn't match the hash
+        :param chunk_hash: Expected SHA256 of the chunk
+        :param data: Chunk data
+        """
+        if not is_hash(chunk_hash) or hashlib.sha256(data).hexdigest() != chunk_hash:
+            return False
+        if self.has_chunk(chunk_hash):
+            self.deduplicated += 1
+        else:
+            self._write(self._chunk_path(chunk_hash), data)
+        return True
+
+    def get_manifest(self, m_hash: str) -> Dict:
+        """
+        Returns manifest or None if it isn't stored
+        :param m_hash: Manifest hash
+        """
+        if not is_hash(m_hash):
+            return None
+        try:
+            with open(self._manifest_path(m_hash), "rb") as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def put_manifest(self, manifest: Dict) -> str:
+        """
+        Stores manifest and returns its hash
+        :param manifest: Manifest dictionary
+        """
+        m_hash = manifest_hash(manifest)
+        if not os.path.exists(self._manifest_path(m_hash)):
+            self._write(self._manifest_path(m_hash), encode_manifest(manifest))
+        return m_hash
+
+    def add_file(self, path: str) -> Tuple[str, Dict]:
+        """
+        Splits file into chunks, stores missing ones and returns manifest hash and manifest.
+        Files added before are only read again if they changed or their chunks are gone.
+        :param path: Path to the firmware file
+        """
+        key = file_key(path)
+        with self._lock:
+            m_hash = self._added.get(key)
+            if m_hash is not None:
+                self._added.move_to_end(key)
+        if m_hash is not None:
+            manifest = self.get_manifest(m_hash)
+            if manifest is not None and not self.missing_chunks(manifest):
+                return m_hash, manifest
+
+        file_hash = hashlib.sha256()
+        chunks = []
+        size = 0
+        with open(path, "rb") as f:
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                file_hash.update(data)
+                chunk_hash = hashlib.sha256(data).hexdigest()
+                self.put_chunk(chunk_hash, data)
+                chunks.append(chunk_hash)
+                size += len(data)
+
+        manifest = {
+            "file_hash": file_hash.hexdigest(),
+            "size": size,
+            "chunk_size": self.chunk_size,
+            "chunks": chunks
+        }
+        m_hash = self.put_manifest(manifest)
+        with self._lock:
+            self._added[key] = m_hash
+            if len(self._added) > self.CACHE_SIZE:
+                self._added.popitem(last=False)
+        return m_hash, manifest
+
+    def missing_chunks(self, manifest: Dict) -> List[str]:
+        """
+        Returns hashes of chunks of a manifest which aren't stored, without duplicates
+        :param manifest: Manifest dictionary
+        """
+        return [h for h in dict.fromkeys(manifest["chunks"]) if not self.has_chunk(h)]
+
+    def assemble(self, m_hash: str, destination: str) -> bool:
+        """
+        Writes file described by a manifest, returns False if it is incomplete or corrupted
+        :param m_hash: Manifest hash
+        :param destination: Path of the output file
+        """
+        manifest = self.get_manifest(m_hash)
+        if manifest is None or self.missing_chunks(manifest):
+            return False
+        file_hash = hashlib.sha256()
+        tmp = destination + ".part"
+        with open(tmp, "wb") as f:
+            for chunk_hash in manifest["chunks"]:
+                data = self.get_chunk(chunk_hash)
+                file_hash.update(data)
+                f.write(data)
+        if file_hash.hexdigest() != manifest["file_hash"]:
+            os.remove(tmp)
+            return False
+        os.replace(tmp, destination)
+        return True
+
+
+class ChunkFetcher:
+    """
+    Downloads a manifest and its missing chunks from all connected peers at once.
+    Each peer has a few requests in flight, every chunk is checked against its hash
+    when it arrives. Chunks not delivered in time or refused are requested from another peer.
+    """
+    MAX_IN_FLIGHT = 4  # Chunk requests per peer at once
+    TIMEOUT = 10.0  # Seconds to wait for a chunk
+
+    def __init__(self, store: BlobStore, send: Callable, peers: Callable[[], List[bytes]]):
+        """
+        ChunkFetcher class constructor
+        :param store: BlobStore receiving the chunks
+        :param send: Function sending a message to a peer: send(peer_id, msg_type, *packets)
+        :param peers: Function returning IDs of connected peers
+        """
+
+        self.store = store
+        self.send = send
+        self.peers = peers
+        self.received = {}  # type: Dict[bytes, int]  # Peer -> number of valid chunks
+        self._lock = threading.RLock()
+        self._manifests = {}  # type: Dict[str, threading.Event]  # Manifest hash -> arrived
+        self._queue = []  # Chunk hashes waiting for a peer
+        self._in_flight = {}  # type: Dict[str, Tuple[bytes, float]]  # Chunk hash -> (peer, sent at)
+        self._refused = {}  # type: Dict[str, set]  # Chunk hash -> peers without it
+        self._done = threading.Condition(self._lock)
+
+    def fetch(self, m_hash: str, timeout: float = 300.0) -> bool:
+        """
+        Downloads manifest and all its chunks, blocks until done.
+        Returns False if some chunks could not be downloaded in time.
+        :param m_hash: Manifest hash
+        :param timeout: Seconds to wait for the whole file
+        """
+        if not is_hash(m_hash):
+            return False
+        deadline = time.monotonic() + timeout
+        manifest = self.store.get_manifest(m_hash)
+        if manifest is None:
+            with self._lock:
+                arrived = self._manifests.setdefault(m_hash, threading.Event())
+            for peer in self.peers():
+                self.send(peer, 'get_manifest', m_hash)
+            if not arrived.wait(min(self.TIMEOUT, timeout)):
+                return False
+            manifest = self.store.get_manifest(m_hash)
+
+        with self._lock:
+            wanted = [h for h in self.store.missing_chunks(manifest)
+                      if h not in self._in_flight and h not in self._queue]
+            self._queue.extend(wanted)
+            self._schedule()
+            while any(h in self._queue or h in self._in_flight for h in manifest["chunks"]):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (not self._in_flight and not self._schedule()):
+                    return False
+                self._done.wait(min(remaining, 1.0))
+                self._check_timeouts()
+        return not self.store.missing_chunks(manifest)
+
+    def _schedule(self) -> bool:
+        """
+        Hands queued chunks to peers with free capacity.
+        Returns False if queued chunks have no peer left to ask.
+        """
+        peers = self.peers()
+        load = {p: 0 for p in peers}
+        for peer, _ in self._in_flight.values():
+            if peer in load:
+                load[peer] += 1
+
+        for chunk_hash in list(self._queue):
+            candidates = [p for p in peers if p not in self._refused.get(chunk_hash, ())
+                          and load[p] < self.MAX_IN_FLIGHT]
+            if not candidates:
+                if not any(p not in self._refused.get(chunk_hash, ()) for p in peers):
+                    self._queue.remove(chunk_hash)  # No peer has it
+                continue
+            # Least busy peer, then the one which delivered the most
+            peer = min(candidates, key=lambda p: (load[p], -self.received.get(p, 0)))
+            load[peer] += 1
+            self._queue.remove(chunk_hash)
+            self._in_flight[chunk_hash] = (peer, time.monotonic())
+            self.send(peer, 'get_chunk', chunk_hash)
+        return bool(self._queue or self._in_flight)
+
+    def _check_timeouts(self):
+        now = time.monotonic()
+        for chunk_hash, (peer, sent) in list(self._in_flight.items()):
+            if now - sent > self.TIMEOUT:
+                del self._in_flight[chunk_hash]
+                self._refused.setdefault(chunk_hash, set()).add(peer)
+                self._queue.append(chunk_hash)
+        self._schedule()
+
+    def on_manifest(self, m_hash: str, data: bytes):
+        """
+        Stores manifest received from a peer if it matches the requested hash
+        :param m_hash: Manifest hash
+        :param data: Canonical manifest JSON or None if the peer doesn't have it
+        """
+        with self._lock:
+            arrived = self._manifests.get(m_hash)
+            if arrived is None or data is None or hashlib.sha256(data).hexdigest() != m_hash:
+                return
+            self.store.put_manifest(json.loads(data))
+            del self._manifests[m_hash]
+        arrived.set()
+
+    def on_chunk(self, peer: bytes, chunk_hash: str, data: bytes):
+        """
+        Stores chunk received from a peer and requests the next ones
+        :param peer: ID of the sender
+        :param chunk_hash: Hash of the chunk
+        :param data: Chunk data or None if the peer doesn't have it
+        """
+        with self._lock:
+            request = self._in_flight.get(chunk_hash)
+            if request is None or request[0] != peer:
+                return  # Late response of a reassigned chunk
+            del self._in_flight[chunk_hash]
+            if data is not None and self.store.put_chunk(chunk_hash, data):
+                self.received[peer] = self.received.get(peer, 0) + 1
+                self._refused.pop(chunk_hash, None)
+            else:
+                self._refused.setdefault(chunk_hash, set()).add(peer)
+                self._queue.append(chunk_hash)
+            self._schedule()
+            self._done.notify_all()
@@ -1,11 +1,44 @@
 import hashlib
 import json
-from typing import Dict, List
+import struct
+from typing import Any, Callable, Dict, List, Tuple
 from datetime import datetime
 
-from merklelib import MerkleTree
-
+from merkle import merkle_proof, merkle_root
+import metrics
+from tracing import tracer
 from transaction import Transaction
+from verification import batch_verifier
+
+# Block header: block_id, prev_hash, timestamp, merkle_root, nonce
+HEADER_FORMAT = struct.Struct(">Q32sd32sQ")
+HEADER_PREFIX_FORMAT = struct.Struct(">Q32sd32s")
+NONCE_FORMAT = struct.Struct(">Q")
+
+DIFFICULTY = 2  # Number of leading zeros required in hash
+
+
+def unpack_header(header: bytes) -> Dict:
+    """
+    Returns fields of a block header
+    :param header: Header bytes, see Block.header
+    """
+    block_id, prev_hash, timestamp, merkle_root, nonce = HEADER_FORMAT.unpack(header)
+    return {
+        "block_id": block_id,
+        "prev_hash": prev_hash.hex(),
+        "timestamp": timestamp,
+        "merkle_root": merkle_root.hex(),
+        "nonce": nonce
+    }
+
+
+def header_hash(header: bytes) -> str:
+    """
+    Returns block hash from its header
+    :param header: Header bytes, see Block.header
+    """
+    return hashlib.sha256(header).hexdigest()
 
 
 class Block:
@@ -13,59 +46,156 @@ class Block:
     Block class.
     """
 
-    def __init__(self, block_id: int, transactions: List[Transaction], datetime: datetime, prev_hash: str):
+    def __init__(self, block_id: int, transactions: List[Transaction], datetime: datetime, prev_hash: str,
+                 merkle_root: str = None):
         """
         Block class constructor
         :param block_id: ID of the block, unique
         :param transactions: List of transactions
         :param datetime: Date and time of block generation
         :param prev_hash: Hash of previous block
+        :param merkle_root: Merkle root declared in a received header, computed from transactions if None
         :param nonce: Parameter to change block hash.
         """
 
+        self._hash = None
+        self._encodings = {}  # Cached serialized forms of the block
+
         self.block_id = block_id
         self.transactions = transactions
+        self._merkle_root = merkle_root
         self.datetime = datetime
         self.prev_hash = prev_hash
         self.nonce = 0
 
+    @property
+    def nonce(self) -> int:
+        return self._nonce
+
+    @nonce.setter
+    def nonce(self, value: int):
+        self._nonce = value
+        self.invalidate_hash()
+
+    @property
+    def transactions(self) -> List[Transaction]:
+        return self._transactions
+
+    @transactions.setter
+    def transactions(self, value: List[Transaction]):
+        self._transactions = value
+        self._merkle_root = None
+        self.invalidate_hash()
+
+    @property
+    def prev_hash(self) -> str:
+        return self._prev_hash
+
+    @prev_hash.setter
+    def prev_hash(self, value: str):
+        self._prev_hash = value
+        self.invalidate_hash()
+
+    def invalidate_hash(self):
+        """
+        Drops cached hash and serialized forms.
+        Use the transactions setter after mutating the transactions list in place.
+        """
+        self._hash = None
+        self._encodings = {}
+
+    def cached_encoding(self, name: str, encode: Callable[["Block"], Any]):
+        """
+        Returns serialized block, encoding it only once until the block changes
+        :param name: Name of the encoding
+        :param encode: Function serializing the block
+        """
+        encoded = self._encodings.get(name)
+        if encoded is None:
+            encoded = encode(self)
+            self._encodings[name] = encoded
+        return encoded
+
+    @property
+    def header_prefix(self) -> bytes:
+        """
+        Returns the constant part of the header, i.e. everything but the nonce
+        """
+        return HEADER_PREFIX_FORMAT.pack(
+            self.block_id,
+            bytes.fromhex(self.prev_hash.rjust(64, "0")),
+            self.datetime.timestamp(),
+            bytes.fromhex(self.merkle_root)
+        )
+
+    @property
+    def header(self) -> bytes:
+        """
+        Returns fixed size block header, which is what the block hash covers
+        """
+        return self.header_prefix + NONCE_FORMAT.pack(self.nonce)
+
     def compute_hash(self) -> str:
         """
-        Computes sha256 hash of the block.
+        Computes sha256 hash of the block header.
+        The result is cached until nonce, transactions or prev_hash change.
         """
 
-        #block = json.dumps(self.representation, sort_keys=True)
-        block = self.toJSON()
-        sha = hashlib.sha256(block.encode()).hexdigest()
-        return sha
+        if self._hash is None:
+            self._hash = header_hash(self.header)
+        return self._hash
 
+    @tracer.trace()
     def verify_block(self) -> bool:
         """
         Verifies block and all its transactions
         """
 
-        for transaction in self.transactions:
-            if not transaction.verify():
-                return False
-
-        return True
+        with metrics.verify_seconds.time(kind="block"):
+            return batch_verifier.verify(self.transactions)
 
     @property
-    def merkle_root(self):
+    def merkle_root(self) -> str:
         """
         Returns a merkle root of the transaction hashes.
         """
 
-        tree = MerkleTree(self.transactions)
-        return tree.merkle_root
+        if self._merkle_root is None:
+            self._merkle_root = self.compute_merkle_root()
+        return self._merkle_root
+
+    def compute_merkle_root(self) -> str:
+        """
+        Computes merkle root of the transaction digests
+        """
+
+        return merkle_root([t.digest for t in self.transactions])
+
+    def merkle_path(self, index: int) -> List[Tuple[str, str]]:
+        """
+        Returns merkle path proving inclusion of a transaction in this block
+        :param index: Position of the transaction in the block
+        """
+
+        return merkle_proof([t.digest for t in self.transactions], index)
+
+    def verify_merkle_root(self) -> bool:
+        """
+        Checks if header's merkle root matches block transactions
+        """
+
+        return self.merkle_root == self.compute_merkle_root()
 
     def __str__(self):
         return f"Block ID: {self.block_id}\nTransactions: {len(self.transactions)}\nHash: {self.compute_hash()}\nLast hash: {self.prev_hash}\n"
 
     def toJSON(self):
         """
-        Serialize block to JSON format
+        Serialize block to JSON format, cached until the block changes
         """
+        return self.cached_encoding("json", Block._to_json)
+
+    def _to_json(self) -> str:
         transactions = [t.toJSON() for t in self.transactions]
 
         return json.dumps({
@@ -73,6 +203,7 @@ class Block:
             "transactions": transactions,
             "datetime": self.datetime.timestamp(),
             "prev_hash": self.prev_hash,
+            "merkle_root": self.merkle_root,
             "nonce": self.nonce
         })
 
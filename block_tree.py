@@ -0,0 +1,180 @@
+from collections import OrderedDict
+from typing import Dict, List
+
+from block import Block
+
+
+class BlockTree:
+    """
+    Tracks competing branches of the chain.
+    The active chain stays in Blockchain, valid blocks of other branches are kept
+    here with their cumulative work, blocks with an unknown parent wait in an orphan pool.
+    When a branch gets more work than the active chain, only the blocks after
+    the fork point are disconnected and the branch is connected instead.
+    """
+    MAX_ORPHANS = 100  # Blocks waiting for their parent, oldest are dropped first
+    KEEP_DEPTH = 100  # Side blocks this far below the tip are forgotten
+
+    def __init__(self, blockchain):
+        """
+        BlockTree class constructor
+        :param blockchain: Blockchain object holding the active chain
+        """
+
+        self.blockchain = blockchain
+        self.side = {}  # type: Dict[str, Block]  # Hash -> valid block outside the active chain
+        self.side_work = {}  # type: Dict[str, int]  # Hash -> cumulative work of a side block
+        self.orphans = OrderedDict()  # type: OrderedDict[str, Block]  # Hash -> block
+        self.reorgs = 0
+
+    @property
+    def block_work(self) -> int:
+        """
+        Returns expected number of hashes needed to mine a block
+        """
+        return 16 ** self.blockchain.DIFFICULTY
+
+    def work(self, block_hash: str) -> int:
+        """
+        Returns cumulative work of a known block, or None if it is unknown
+        :param block_hash: Hash of the block
+        """
+        position = self.blockchain.block_index.get(block_hash)
+        if position is not None:
+            return (position + 1) * self.block_work
+        return self.side_work.get(block_hash)
+
+    @property
+    def tip_work(self) -> int:
+        """
+        Returns cumulative work of the active chain
+        """
+        return len(self.blockchain.chain) * self.block_work
+
+    def __contains__(self, block_hash: str) -> bool:
+        return (block_hash in self.blockchain.block_index or block_hash in self.side
+                or block_hash in self.orphans)
+
+    def receive_block(self, block: Block) -> str:
+        """
+        Adds block received from a peer, switching to its branch if it has the most work.
+        Returns "connected", "reorg", "side", "orphan", "duplicate" or "invalid".
+        :param block: Block object
+        """
+        with self.blockchain.lock:
+            if block.compute_hash() in self:
+                return "duplicate"
+            if self.work(block.prev_hash) is None:
+                self._add_orphan(block)
+                return "orphan"
+
+            status = self._connect(block)
+            # Orphans waiting for this block, and for their children
+            parents = [block.compute_hash()] if status != "invalid" else []
+            while parents:
+                parent = parents.pop()
+                for child in [o for o in self.orphans.values() if o.prev_hash == parent]:
+                    del self.orphans[child.compute_hash()]
+                    child_status = self._connect(child)
+                    if child_status != "invalid":
+                        parents.append(child.compute_hash())
+                        if status != "reorg":
+                            status = child_status
+            self._prune()
+            return status
+
+    def _add_orphan(self, block: Block):
+        self.orphans[block.compute_hash()] = block
+        while len(self.orphans) > self.MAX_ORPHANS:
+            self.orphans.popitem(last=False)
+
+    def _height(self, block_hash: str) -> int:
+        position = self.blockchain.block_index.get(block_hash)
+        if position is not None:
+            return position
+        return self.side[block_hash].block_id
+
+    def _connect(self, block: Block) -> str:
+        """
+        Validates block whose parent is known and attaches it to the tree
+        """
+        block_hash = block.compute_hash()
+        if block.prev_hash == self.blockchain.last_hash:
+            return "connected" if self.blockchain.extend_chain([block]) else "invalid"
+
+        if not self.blockchain.validate_blocks([block], block.prev_hash,
+                                               self._height(block.prev_hash) + 1):
+            return "invalid"
+        self.side[block_hash] = block
+        self.side_work[block_hash] = self.work(block.prev_hash) + self.block_work
+        # Ties keep the active chain, the first seen branch wins
+        if self.side_work[block_hash] > self.tip_work:
+            return "reorg" if self.reorg(block_hash) else "invalid"
+        return "side"
+
+    def branch(self, tip_hash: str) -> List[Block]:
+        """
+        Returns side blocks from the fork point with the active chain to given block
+        :param tip_hash: Hash of a side block
+        """
+        blocks = []
+        while tip_hash in self.side:
+            blocks.append(self.side[tip_hash])
+            tip_hash = self.side[tip_hash].prev_hash
+        blocks.reverse()
+        return blocks
+
+    def reorg(self, tip_hash: str) -> bool:
+        """
+        Makes the branch ending with given side block the active chain
+        :param tip_hash: Hash of a side block
+        """
+        return self.switch(self.branch(tip_hash))
+
+    def switch(self, branch: List[Block]) -> bool:
+        """
+        Replaces blocks of the active chain after the fork point with a branch.
+        Disconnected blocks are kept as side blocks, their transactions go back
+        to pending transactions. If the branch is invalid the old blocks are put back.
+        :param branch: Consecutive blocks, the first one's parent in the active chain
+        """
+        with self.blockchain.lock:
+            fork = self.blockchain.block_index.get(branch[0].prev_hash) if branch else None
+            if fork is None:
+                return False
+
+            removed = self.blockchain.truncate(fork + 1)
+            if not self.blockchain.extend_chain(branch):
+                # Put the old blocks back, the branch is invalid
+                self.blockchain.truncate(fork + 1)
+                self.blockchain.extend_chain(removed)
+                for block in branch:
+                    self.side.pop(block.compute_hash(), None)
+                    self.side_work.pop(block.compute_hash(), None)
+                return False
+
+            for block in branch:
+                self.side.pop(block.compute_hash(), None)
+                self.side_work.pop(block.compute_hash(), None)
+            for position, block in enumerate(removed, fork + 1):
+                self.side[block.compute_hash()] = block
+                self.side_work[block.compute_hash()] = (position + 1) * self.block_work
+            self.reorgs += 1
+            print(f"Reorganized {len(removed)} blocks, new tip {self.blockchain.last_hash}")
+            return True
+
+    def _prune(self):
+        """
+        Forgets side blocks too deep below the tip to ever win
+        """
+        limit = len(self.blockchain.chain) - self.KEEP_DEPTH
+        for block_hash in [h for h, b in self.side.items() if b.block_id < limit]:
+            del self.side[block_hash]
+            del self.side_work[block_hash]
+
+    @property
+    def stats(self) -> dict:
+        """
+        Returns numbers of side blocks, orphans and reorganizations
+        """
+        return {"side": len(self.side), "orphans": len(self.orphans), "reorgs": self.reorgs}
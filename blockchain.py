@@ -1,93 +1,106 @@
 from datetime import datetime
-from typing import Dict, Tuple
-import os
+from typing import Dict, List, Tuple
 import json
+import os
+import threading
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
 from cryptography.hazmat.backends.openssl.rsa import (_RSAPrivateKey,
                                                       _RSAPublicKey)
 import py2p
-from merklelib import MerkleTree
 
-from block import Block
+from block import DIFFICULTY, Block
+from blob_store import BlobStore
+from block_tree import BlockTree
+from chain_store import ChainStore, StoredChain
+from codec import dumps_block, dumps_transaction
+from firmware import firmware_hasher
+from gossip import Gossip
+from keys import KeyManager, key_manager
+from mempool import Mempool
+from merkle import MerkleAccumulator
+import metrics
+from miner import Miner
+from tracing import tracer
 from transaction import Transaction
+from trusted_keys import trusted_keys
+from verification import batch_verifier
 
 
 class Blockchain:
     """
     Stores and manages blocks and transactions
     """
-    DIFFICULTY = 2  # Number of leading zeros required in hash
+    DIFFICULTY = DIFFICULTY  # Number of leading zeros required in hash
+    VERIFY_WINDOW = 1000  # Blocks loaded and validated at once by verify_chain
 
-    def __init__(self, sock: py2p.MeshSocket = None):
+    def __init__(self, sock: py2p.MeshSocket = None, store: ChainStore = None):
         """
         Blockchain class constructor
+        :param sock: Mesh socket used to broadcast transactions and blocks
+        :param store: On-disk block log, the chain is kept in memory only if None
         """
 
-        self.chain = []
-        self.pending_transactions = []
-        genesis_block = Block(0, [], datetime(2000, 1, 1, 0, 0), "0")
-        genesis_block, new_hash = self.proof_of_work(genesis_block)
-        self.chain.append(genesis_block)
+        self.store = store
+        # Held while changing the chain or mempool, shared by network, console and REST threads
+        self.lock = threading.RLock()
+        if store is not None:
+            self.chain = StoredChain(store)
+            self.block_index = store.hash_index  # Maps block hash to position
+            self.accumulator = MerkleAccumulator(os.path.join(store.path, "accumulator.json"))
+            # Saved with the block log, saved state never runs ahead of synced blocks
+            store.on_sync = self._save_state
+        else:
+            self.chain = []
+            self.block_index = {}  # Maps block hash to position
+            self.accumulator = MerkleAccumulator()
+        self._file_index = None  # Maps file hash to [(block position, transaction position)]
+        self.pending_transactions = Mempool()
+        self.tree = BlockTree(self)  # Competing branches received from peers
+        # Highest block verified by verify_chain and its hash, genesis is trusted
+        self.verified_height = 0
+        self.verified_hash = None
+
+        if len(self.chain) == 0:
+            genesis_block = Block(0, [], datetime(2000, 1, 1, 0, 0), "0" * 64)
+            genesis_block, new_hash = self.proof_of_work(genesis_block)
+            self.append_block(genesis_block)
+        # Saved frontier is behind the chain after a crash, add the missing blocks
+        count = self.accumulator.count
+        if 0 < count <= len(self.chain) and self.accumulator.last_leaf == self.block_hash(count - 1):
+            for i in range(count, len(self.chain)):
+                self.accumulator.append(self.block_hash(i))
+        else:
+            self.accumulator.rebuild(self.block_hash(i) for i in range(len(self.chain)))
+        self.verified_hash = self.block_hash(0)
+        self._load_checkpoint()
         self.sock = sock
+        self.gossip = Gossip(self._send_transactions)
+        self.wire_format = "json"  # Format of broadcast blocks and transactions
+        self.miner = Miner()
 
         # generate private key and public key if not found
-        if not ("private_key.pem" in os.listdir() and "public_key.pem" in os.listdir()):
-            private_key = Blockchain.generate_private_key()
-            public_key = Blockchain.generate_public_key(private_key)
-
-            public_pem = public_key.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            )
-
-            private_pem = private_key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.PKCS8,
-                encryption_algorithm=serialization.NoEncryption()
-            )
-
-            with open('public_key.pem', 'wb') as f:
-                f.write(public_pem)
-
-            with open('private_key.pem', 'wb') as f:
-                f.write(private_pem)
+        key_manager.ensure_keys()
 
     @property
     def private_key(self) -> _RSAPrivateKey:
         """
         Returns private key object
         """
-        with open("private_key.pem", "rb") as private_key_file:
-            return serialization.load_pem_private_key(
-                private_key_file.read(),
-                password=None,
-                backend=default_backend()
-            )
+        return key_manager.private_key
 
     @property
     def public_key(self) -> _RSAPublicKey:
         """
         Returns public key object
         """
-        with open("public_key.pem", "rb") as key_file:
-            return serialization.load_pem_public_key(
-                key_file.read(),
-                backend=default_backend()
-            )
+        return key_manager.public_key
 
     @classmethod
     def generate_private_key(cls) -> _RSAPrivateKey:
         """
         Generates private key
         """
-        return rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=2048,
-            backend=default_backend()
-        )
+        return KeyManager.generate_private_key()
 
     @classmethod
     def generate_public_key(cls, private_key: _RSAPrivateKey):
@@ -97,18 +110,30 @@ class Blockchain:
         """
         return private_key.public_key()
 
+    @tracer.trace()
     def add_transaction(self, transaction: Transaction) -> bool:
         """
-        Adds transaction to pending transactions.
+        Adds transaction to pending transactions and relays it to peers.
+        Returns False if it is invalid, its author isn't trusted or it is already pending.
         :param transaction: Transaction object
         """
-        if transaction.verify():
-            self.pending_transactions.append(transaction)
-            if self.sock is not None:
-                self.sock.send(transaction.toJSON(), type='new_transaction')
-            return True
-        else:
+        if not trusted_keys.admits(transaction.public_key) or not transaction.verify():
             return False
+        with self.lock:
+            if not self.pending_transactions.add(transaction):
+                return False
+        if self.sock is not None:
+            self.gossip.relay(dumps_transaction(transaction, self.wire_format),
+                              transaction.digest)
+        return True
+
+    def _send_transactions(self, payloads: list):
+        """
+        Broadcasts a batch of encoded transactions as one message
+        :param payloads: Encoded transactions
+        """
+        if self.sock is not None:
+            self.sock.send(*payloads, type='new_transaction')
 
     def add_transaction_from_dict(self, d: Dict[str, str]) -> bool:
         """
@@ -124,16 +149,46 @@ class Blockchain:
 
         return self.add_transaction(transaction)
 
-    # todo change algorithm
+    def add_transaction_from_file(self, path: str, version: str, filename: str = None,
+                                  blobs: BlobStore = None) -> Transaction:
+        """
+        Hashes firmware file, creates and signs transaction and adds it to pending transactions.
+        Returns the transaction, or None if it was rejected.
+        :param path: Path to the update file
+        :param version: Software update version
+        :param filename: Name of update file, the file's base name by default
+        :param blobs: Blob store to share the file from, its manifest is referenced by the transaction
+        """
+        if blobs is not None:
+            m_hash, manifest = blobs.add_file(path)
+            file_hash = manifest["file_hash"]
+        else:
+            m_hash, file_hash = None, firmware_hasher.hash_file(path)
+        transaction = Transaction(
+            self.public_key,
+            version,
+            file_hash,
+            filename or os.path.basename(path),
+            m_hash
+        )
+        transaction.sign(self.private_key)
+
+        return transaction if self.add_transaction(transaction) else None
+
+    @tracer.trace()
     def proof_of_work(self, block) -> Tuple[Block, str]:
         """
         Computes hash until it has a proper number of leading zeros by increasing nonce.
+        Single threaded, used for the genesis block. See Miner for the parallel version.
         :param block: Block object whose hash will be computed
         """
-        computed = block.compute_hash()
-        while not computed.startswith('0' * self.DIFFICULTY):
-            block.nonce = block.nonce + 1
+        start = block.nonce
+        with metrics.pow_seconds.time():
             computed = block.compute_hash()
+            while not computed.startswith('0' * self.DIFFICULTY):
+                block.nonce = block.nonce + 1
+                computed = block.compute_hash()
+        metrics.pow_attempts.inc(block.nonce - start + 1)
         return block, computed
 
     def proof_of_authority(self):
@@ -151,45 +206,303 @@ class Blockchain:
 
         return self.chain[-1]
 
+    @property
+    def last_hash(self) -> str:
+        """
+        Returns the hash of the last block of the chain
+        """
+
+        return self.last_block.compute_hash()
+
+    def block_hash(self, position: int) -> str:
+        """
+        Returns hash of the block at given position.
+        Read from the store index when possible, without loading the block.
+        :param position: Position of the block in the chain
+        """
+
+        if self.store is not None:
+            return self.store.block_hash(position)
+        return self.chain[position].compute_hash()
+
+    def append_block(self, block: Block):
+        """
+        Appends block to the chain and indexes it by hash
+        :param block: Block object
+        """
+
+        with self.lock:
+            self.chain.append(block)
+            self.block_index[block.compute_hash()] = len(self.chain) - 1
+            self.accumulator.append(block.compute_hash())
+            if self._file_index is not None:
+                self._index_files(len(self.chain) - 1, block)
+
+    def set_chain(self, chain: List[Block]):
+        """
+        Replaces the whole chain and rebuilds the hash index
+        :param chain: List of blocks
+        """
+
+        with self.lock:
+            if self.store is not None:
+                self.chain.truncate(0)
+            else:
+                self.chain = []
+            self.block_index.clear()
+            for block in chain:
+                self.chain.append(block)
+                self.block_index[block.compute_hash()] = len(self.chain) - 1
+            self.accumulator.rebuild(self.block_hash(i) for i in range(len(self.chain)))
+            self._file_index = None
+            self.reset_checkpoint()
+            self.tree = BlockTree(self)
+
+    def close(self):
+        """
+        Stops mining and closes the block store
+        """
+
+        self.miner.close()
+        self.gossip.flush()
+        if self.store is not None:
+            self.store.close()
+
+    @tracer.trace()
     def mine(self):
         """
         Mines a new block with a Proof of Work and adds it to the chain.
         """
 
-        if len(self.pending_transactions) > 0:
+        with self.lock:
+            if len(self.pending_transactions) == 0:
+                return
             new_id = self.last_block.block_id + 1
-            prev_hash = self.last_block.compute_hash()
-            time = datetime.now()
+            prev_hash = self.last_hash
+            block = Block(new_id, self.pending_transactions.peek(),
+                          datetime.now(), prev_hash)
 
-            block = Block(new_id, self.pending_transactions,
-                          time, prev_hash)
-            block, new_hash = self.proof_of_work(block)
+        # Lock isn't held while searching for the nonce
+        if self.miner.mine(block, self.DIFFICULTY) is None:
+            print("Mining cancelled")
+            return
+        with self.lock:
+            # Chain moved on while mining
+            if block.prev_hash != self.last_hash:
+                print("Mined block is stale")
+                return
             # Send out block
             if self.sock is not None:
-                self.sock.send(block.toJSON(), type='mined')
-            self.chain.append(block)
-            self.pending_transactions = []
-            print("Mined")
+                self.sock.send(dumps_block(block, self.wire_format), type='mined')
+            self.append_block(block)
+            self.pending_transactions.remove_many(block.transactions)
+        print("Mined")
+
+    def reset_checkpoint(self, height: int = 0):
+        """
+        Marks blocks above given height as not verified
+        :param height: Highest block still considered verified, genesis by default
+        """
+        height = min(height, self.verified_height, len(self.chain) - 1)
+        self.verified_height = height
+        self.verified_hash = self.block_hash(height)
+
+    @property
+    def _checkpoint_path(self) -> str:
+        return os.path.join(self.store.path, "checkpoint.json")
+
+    def _load_checkpoint(self):
+        """
+        Restores verified height saved with the block log, if the block is still there
+        """
+        if self.store is None or not os.path.exists(self._checkpoint_path):
+            return
+        try:
+            with open(self._checkpoint_path, "r") as f:
+                data = json.load(f)
+            height, block_hash = int(data["height"]), data["hash"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        if 0 < height < len(self.chain) and self.block_hash(height) == block_hash:
+            self.verified_height = height
+            self.verified_hash = block_hash
 
+    def _save_state(self):
+        """
+        Saves the accumulator frontier and the verified checkpoint next to the block log
+        """
+        self.accumulator.save()
+        if self.store is None or self.verified_hash is None:
+            return
+        tmp_path = self._checkpoint_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"height": self.verified_height, "hash": self.verified_hash}, f)
+        os.replace(tmp_path, self._checkpoint_path)
+
+    @tracer.trace()
     def verify_chain(self) -> bool:
         """
-        Verifies if chain is valid
+        Verifies if chain is valid.
+        Only blocks above the last verified height are checked, VERIFY_WINDOW blocks
+        at a time: headers first, then all their signatures as one parallel batch.
+        The checkpoint moves after every valid window.
         """
-        for i in range(1, len(self.chain)):
-            if self.chain[i].prev_hash != self.chain[i-1].compute_hash():
-                return False
-            elif not self.chain[i].compute_hash().startswith('0'*self.DIFFICULTY):
-                return False
-            elif not self.chain[i].verify_block():
+        with self.lock:
+            # Checkpointed block replaced without calling set_chain
+            if (self.verified_height >= len(self.chain)
+                    or self.block_hash(self.verified_height) != self.verified_hash):
+                self.reset_checkpoint()
+
+            start = self.verified_height + 1
+            while start < len(self.chain):
+                end = min(start + self.VERIFY_WINDOW, len(self.chain))
+                if not self.validate_blocks(self.chain[start:end], self.verified_hash, start):
+                    return False
+                self.verified_height = end - 1
+                self.verified_hash = self.block_hash(end - 1)
+                start = end
+            return True
+
+    def validate_blocks(self, blocks: List[Block], prev_hash: str, height: int) -> bool:
+        """
+        Checks that blocks form a valid chain following a given block:
+        linkage, block IDs, proof of work, merkle roots, trusted authors and all signatures.
+        :param blocks: Consecutive blocks
+        :param prev_hash: Hash of the block preceding the first one
+        :param height: Expected ID of the first block
+        """
+        with metrics.verify_seconds.time(kind="chain"):
+            for i, block in enumerate(blocks):
+                if block.prev_hash != prev_hash or block.block_id != height + i:
+                    return False
+                prev_hash = block.compute_hash()
+                if not prev_hash.startswith('0'*self.DIFFICULTY):
+                    return False
+                elif not block.verify_merkle_root():
+                    return False
+                elif not trusted_keys.admits_all(t.public_key for t in block.transactions):
+                    return False
+            return batch_verifier.verify_blocks(blocks)
+
+    def extend_chain(self, blocks: List[Block]) -> bool:
+        """
+        Validates blocks following the current tip and appends them.
+        Nothing is appended if any block is invalid.
+        :param blocks: Consecutive blocks
+        """
+        with self.lock:
+            if not self.validate_blocks(blocks, self.last_hash, len(self.chain)):
                 return False
-        return True
+
+            verified = self.verified_height == len(self.chain) - 1
+            for block in blocks:
+                self.append_block(block)
+                self.pending_transactions.remove_many(block.transactions)
+            if blocks:
+                self.miner.cancel_height(blocks[-1].block_id)
+            if verified:
+                self.verified_height = len(self.chain) - 1
+                self.verified_hash = self.last_hash
+            return True
+
+    def truncate(self, length: int) -> List[Block]:
+        """
+        Removes blocks from given position to the tip and returns them.
+        Their transactions go back to pending transactions.
+        :param length: Number of blocks to keep, at least 1 to keep genesis
+        """
+        with self.lock:
+            length = max(length, 1)
+            removed = self.chain[length:]
+            if not removed:
+                return []
+
+            if self.store is not None:
+                self.chain.truncate(length)
+            else:
+                del self.chain[length:]
+            for block in removed:
+                self.block_index.pop(block.compute_hash(), None)
+                if self._file_index is not None:
+                    self._unindex_files(length, block)
+            if not self.accumulator.truncate(length):
+                self.accumulator.rebuild(self.block_hash(i) for i in range(len(self.chain)))
+            self.reset_checkpoint(length - 1)
+            self._save_state()
+
+            for block in removed:
+                for transaction in block.transactions:
+                    self.pending_transactions.add(transaction)
+            return removed
+
+    def get_blocks(self, from_height: int, limit: int) -> List[Block]:
+        """
+        Returns up to limit blocks starting at given height
+        :param from_height: ID of the first block
+        :param limit: Maximum number of blocks
+        """
+        with self.lock:
+            from_height = max(from_height, 0)
+            return self.chain[from_height:from_height + limit]
 
     @property
     def blockchain_root(self) -> str:
         """
-        Calculates merkle tree root of the whole blockchain
+        Returns merkle tree root of the hashes of all blocks in the chain.
+        Kept up to date by the accumulator, so it is never rebuilt from scratch.
+        """
+        return self.accumulator.root
+
+    def _index_files(self, position: int, block: Block):
+        for i, transaction in enumerate(block.transactions):
+            self._file_index.setdefault(transaction.file_hash, []).append((position, i))
+
+    def _unindex_files(self, length: int, block: Block):
+        for transaction in block.transactions:
+            positions = self._file_index.get(transaction.file_hash)
+            while positions and positions[-1][0] >= length:
+                positions.pop()
+            if not positions:
+                self._file_index.pop(transaction.file_hash, None)
+
+    def find_transaction(self, file_hash: str) -> Tuple[int, int]:
         """
-        return MerkleTree(self.chain).merkle_root
+        Returns positions of the block and the latest transaction with given file hash,
+        or None if not found. The file index is built on first use.
+        :param file_hash: SHA256 hash of update file
+        """
+        if self._file_index is None:
+            self._file_index = {}
+            for position, block in enumerate(self.chain):
+                self._index_files(position, block)
+        positions = self._file_index.get(file_hash)
+        return positions[-1] if positions else None
+
+    def get_proof(self, file_hash: str, from_height: int = None) -> Dict:
+        """
+        Returns proof that a transaction with given file hash is in the chain:
+        the transaction, its merkle path and block headers up to the tip.
+        Returns None if the file hash is unknown.
+        :param file_hash: SHA256 hash of update file
+        :param from_height: First header to include, defaults to the block with the transaction
+        """
+        with self.lock:
+            found = self.find_transaction(file_hash)
+            if found is None:
+                return None
+            position, index = found
+            if from_height is None or from_height > position:
+                from_height = position
+            from_height = max(from_height, 0)
+
+            block = self.chain[position]
+            return {
+                "block_id": block.block_id,
+                "transaction": block.transactions[index].toJSON(),
+                "path": block.merkle_path(index),
+                "from_height": from_height,
+                "headers": [b.header.hex() for b in self.chain[from_height:]]
+            }
 
     def toJSON(self):
         """
@@ -0,0 +1,328 @@
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from codec import decode_block, encode_block
+
+RECORD_HEADER = struct.Struct(">II32s")  # payload length, crc32 of payload, block hash
+INDEX_ENTRY = struct.Struct(">IQI32s")  # segment number, record offset, payload length, block hash
+
+
+class ChainStore:
+    """
+    Append-only block log split into segment files.
+    Every record is indexed by block position and hash in a separate index file,
+    so opening the store only reads the index and the unindexed tail of the log.
+    """
+    SEGMENT_SIZE = 64 * 1024 * 1024  # Maximum size of a single segment file
+
+    def __init__(self, path: str, serialize: Callable = None, deserialize: Callable = None,
+                 sync_every: int = 64, segment_size: int = None):
+        """
+        ChainStore class constructor
+        :param path: Directory with segment and index files, created if missing
+        :param serialize: Function returning bytes of a block, msgpack by default
+        :param deserialize: Function returning a block from bytes, msgpack by default
+        :param sync_every: Number of appended blocks after which files are fsynced
+        :param segment_size: Maximum segment size in bytes
+        """
+
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.serialize = serialize or encode_block
+        self.deserialize = deserialize or decode_block
+        self.sync_every = sync_every
+        if segment_size is not None:
+            self.SEGMENT_SIZE = segment_size
+
+        self.entries = []  # type: List[Tuple[int, int, int, bytes]]
+        self.hash_index = {}  # type: Dict[str, int]
+        self._maps = {}  # Segment number -> read only mmap
+        self._unsynced = 0
+        self._lock = threading.RLock()
+        self.on_sync = None  # Called after every sync, saves state derived from the blocks
+
+        self._recover()
+        self._segment_no = self.entries[-1][0] if self.entries else 0
+        self._segment = open(self._segment_path(self._segment_no), "ab")
+        self._index = open(self._index_path, "ab")
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.path, "index.dat")
+
+    def _segment_path(self, segment_no: int) -> str:
+        return os.path.join(self.path, f"blocks-{segment_no:05d}.log")
+
+    def _recover(self):
+        """
+        Loads the index, drops entries pointing past the data,
+        indexes complete records missing from the index and truncates a torn tail.
+        """
+        data = b""
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "rb") as f:
+                data = f.read()
+        count = len(data) // INDEX_ENTRY.size
+        entries = list(INDEX_ENTRY.iter_unpack(data[:count * INDEX_ENTRY.size]))
+
+        # Data is synced before the index, but don't trust either after a crash
+        sizes = {}
+        valid = 0
+        for segment_no, offset, length, _ in entries:
+            if segment_no not in sizes:
+                path = self._segment_path(segment_no)
+                sizes[segment_no] = os.path.getsize(path) if os.path.exists(path) else -1
+            if offset + RECORD_HEADER.size + length > sizes[segment_no]:
+                break
+            valid += 1
+        del entries[valid:]
+
+        if entries:
+            segment_no, offset, length, _ = entries[-1]
+            position = offset + RECORD_HEADER.size + length
+        else:
+            segment_no, position = 0, 0
+
+        # Scan records written after the last index entry
+        while os.path.exists(self._segment_path(segment_no)):
+            path = self._segment_path(segment_no)
+            torn = False
+            with open(path, "rb") as f:
+                f.seek(position)
+                while True:
+                    head = f.read(RECORD_HEADER.size)
+                    if len(head) < RECORD_HEADER.size:
+                        torn = len(head) > 0
+                        break
+                    length, crc, block_hash = RECORD_HEADER.unpack(head)
+                    payload = f.read(length)
+                    if len(payload) < length or zlib.crc32(payload) != crc:
+                        torn = True
+                        break
+                    entries.append((segment_no, position, length, block_hash))
+                    position += RECORD_HEADER.size + length
+
+            if torn or not os.path.exists(self._segment_path(segment_no + 1)):
+                os.truncate(path, position)
+                self._remove_segments_after(segment_no)
+                break
+            segment_no, position = segment_no + 1, 0
+
+        if len(entries) != count or len(data) != count * INDEX_ENTRY.size:
+            with open(self._index_path, "wb") as f:
+                f.write(b"".join(INDEX_ENTRY.pack(*e) for e in entries))
+                f.flush()
+                os.fsync(f.fileno())
+
+        self.entries = entries
+        self.hash_index = {e[3].hex(): i for i, e in enumerate(entries)}
+
+    def _remove_segments_after(self, segment_no: int):
+        """
+        Deletes segment files following given segment
+        """
+        segment_no += 1
+        while os.path.exists(self._segment_path(segment_no)):
+            os.remove(self._segment_path(segment_no))
+            segment_no += 1
+
+    def append(self, block):
+        """
+        Appends block to the log
+        :param block: Block object
+        """
+        payload = self.serialize(block)
+        block_hash = bytes.fromhex(block.compute_hash())
+        record = RECORD_HEADER.pack(len(payload), zlib.crc32(payload), block_hash)
+
+        with self._lock:
+            offset = self._segment.tell()
+            if offset > 0 and offset + len(record) + len(payload) > self.SEGMENT_SIZE:
+                self._roll()
+                offset = 0
+            self._segment.write(record + payload)
+
+            entry = (self._segment_no, offset, len(payload), block_hash)
+            self._index.write(INDEX_ENTRY.pack(*entry))
+            self.entries.append(entry)
+            self.hash_index[block_hash.hex()] = len(self.entries) - 1
+
+            self._unsynced += 1
+            if self._unsynced >= self.sync_every:
+                self.sync()
+
+    def _roll(self):
+        """
+        Closes current segment and starts a new one
+        """
+        self.sync()
+        self._segment.close()
+        self._segment_no += 1
+        self._segment = open(self._segment_path(self._segment_no), "ab")
+
+    def sync(self):
+        """
+        Writes buffered records to disk, the log before the index
+        """
+        with self._lock:
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+            self._index.flush()
+            os.fsync(self._index.fileno())
+            self._unsynced = 0
+            if self.on_sync is not None:
+                self.on_sync()
+
+    def _map(self, segment_no: int, end: int) -> mmap.mmap:
+        """
+        Returns mmap of a segment covering at least `end` bytes
+        """
+        mapped = self._maps.get(segment_no)
+        if mapped is None or len(mapped) < end:
+            if segment_no == self._segment_no:
+                self._segment.flush()
+            if mapped is not None:
+                mapped.close()
+            with open(self._segment_path(segment_no), "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment_no] = mapped
+        return mapped
+
+    def read(self, position: int) -> bytes:
+        """
+        Returns serialized block at given position
+        :param position: Position of the block in the chain
+        """
+        with self._lock:
+            segment_no, offset, length, _ = self.entries[position]
+            start = offset + RECORD_HEADER.size
+            return self._map(segment_no, start + length)[start:start + length]
+
+    def get(self, position: int):
+        """
+        Returns block at given position
+        :param position: Position of the block in the chain
+        """
+        return self.deserialize(self.read(position))
+
+    def block_hash(self, position: int) -> str:
+        """
+        Returns hash of the block at given position without reading the block
+        :param position: Position of the block in the chain
+        """
+        return self.entries[position][3].hex()
+
+    def truncate(self, length: int):
+        """
+        Removes all blocks from given position to the end
+        :param length: Number of blocks to keep
+        """
+        with self._lock:
+            if length >= len(self.entries):
+                return
+            self.sync()
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps = {}
+            self._segment.close()
+            self._index.close()
+
+            segment_no, offset, _, _ = self.entries[length]
+            self._remove_segments_after(segment_no)
+            os.truncate(self._segment_path(segment_no), offset)
+            os.truncate(self._index_path, length * INDEX_ENTRY.size)
+
+            for entry in self.entries[length:]:
+                del self.hash_index[entry[3].hex()]
+            del self.entries[length:]
+
+            self._segment_no = segment_no
+            self._segment = open(self._segment_path(segment_no), "ab")
+            self._index = open(self._index_path, "ab")
+
+    def close(self):
+        """
+        Syncs and closes all files
+        """
+        with self._lock:
+            self.sync()
+            for mapped in self._maps.values():
+                mapped.close()
+            self._maps = {}
+            self._segment.close()
+            self._index.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class StoredChain:
+    """
+    List-like view of a chain kept in a ChainStore.
+    Only recently used blocks are kept in memory.
+    """
+    CACHE_SIZE = 256  # Number of deserialized blocks kept in memory
+
+    def __init__(self, store: ChainStore):
+        """
+        StoredChain class constructor
+        :param store: ChainStore object
+        """
+
+        self.store = store
+        self._cache = OrderedDict()
+
+    def _remember(self, position: int, block):
+        self._cache[position] = block
+        while len(self._cache) > self.CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def _get(self, position: int):
+        block = self._cache.get(position)
+        if block is None:
+            block = self.store.get(position)
+            self._remember(position, block)
+        else:
+            self._cache.move_to_end(position)
+        return block
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self._get(i) for i in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("chain index out of range")
+        return self._get(item)
+
+    def __len__(self):
+        return len(self.store)
+
+    def __iter__(self) -> Iterator:
+        for i in range(len(self)):
+            yield self._get(i)
+
+    def append(self, block):
+        """
+        Appends block to the store
+        :param block: Block object
+        """
+        self.store.append(block)
+        self._remember(len(self) - 1, block)
+
+    def truncate(self, length: int):
+        """
+        Removes blocks from given position to the end
+        :param length: Number of blocks to keep
+        """
+        self.store.truncate(length)
+        for position in [p for p in self._cache if p >= length]:
+            del self._cache[position]
+
+    def __repr__(self):
+        return f"StoredChain({len(self)} blocks)"
@@ -0,0 +1,223 @@
+import json
+import time
+from datetime import datetime
+from typing import Dict, List, Union
+
+import umsgpack
+
+from block import Block
+from keys import key_manager
+from transaction import Transaction
+
+FORMAT_VERSION = 1  # First field of every encoded block
+FORMATS = ("json", "msgpack")
+
+
+def _int_to_bytes(n: int) -> bytes:
+    return n.to_bytes((n.bit_length() + 7) // 8, "big")
+
+
+def transaction_to_list(transaction: Transaction) -> list:
+    """
+    Returns transaction as a list of msgpack friendly fields
+    :param transaction: Transaction object
+    """
+    numbers = transaction.public_key.public_numbers()
+    fields = [
+        _int_to_bytes(numbers.n),
+        numbers.e,
+        transaction.version,
+        transaction.file_hash,
+        transaction.filename,
+        getattr(transaction, "signature", None)
+    ]
+    # Optional trailing field
+    if transaction.manifest is not None:
+        fields.append(transaction.manifest)
+    return fields
+
+
+def transaction_from_list(fields: list) -> Transaction:
+    """
+    Returns transaction from a list of fields
+    :param fields: List created by transaction_to_list
+    """
+    n, e, version, file_hash, filename, signature = fields[:6]
+    manifest = fields[6] if len(fields) > 6 else None
+    public_key = key_manager.from_numbers(int.from_bytes(n, "big"), e)
+    transaction = Transaction(public_key, version, file_hash, filename, manifest)
+    if signature is not None:
+        transaction.signature = signature
+    return transaction
+
+
+def block_to_list(block: Block) -> list:
+    """
+    Returns block as a list of msgpack friendly fields
+    :param block: Block object
+    """
+    return [
+        FORMAT_VERSION,
+        block.block_id,
+        block.datetime.timestamp(),
+        bytes.fromhex(block.prev_hash),
+        bytes.fromhex(block.merkle_root),
+        block.nonce,
+        [transaction_to_list(t) for t in block.transactions]
+    ]
+
+
+def block_from_list(fields: list) -> Block:
+    """
+    Returns block from a list of fields
+    :param fields: List created by block_to_list
+    """
+    version, block_id, timestamp, prev_hash, merkle_root, nonce, transactions = fields
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported block format version: {version}")
+    block = Block(
+        block_id,
+        [transaction_from_list(t) for t in transactions],
+        datetime.fromtimestamp(timestamp),
+        prev_hash.hex(),
+        merkle_root.hex()
+    )
+    block.nonce = nonce
+    return block
+
+
+def encode_transaction(transaction: Transaction) -> bytes:
+    """
+    Serializes transaction to msgpack
+    :param transaction: Transaction object
+    """
+    return umsgpack.packb(transaction_to_list(transaction))
+
+
+def decode_transaction(data: bytes) -> Transaction:
+    """
+    Returns transaction from msgpack data
+    :param data: Encoded transaction
+    """
+    return transaction_from_list(umsgpack.unpackb(data))
+
+
+def encode_block(block: Block) -> bytes:
+    """
+    Serializes block to msgpack, cached until the block changes
+    :param block: Block object
+    """
+    return block.cached_encoding("msgpack", lambda b: umsgpack.packb(block_to_list(b)))
+
+
+def decode_block(data: bytes) -> Block:
+    """
+    Returns block from msgpack data
+    :param data: Encoded block
+    """
+    return block_from_list(umsgpack.unpackb(data))
+
+
+def array_header(length: int) -> bytes:
+    """
+    Returns msgpack array header, followed by `length` packed items
+    :param length: Number of items
+    """
+    if length < 16:
+        return bytes([0x90 | length])
+    if length < 2 ** 16:
+        return b"\xdc" + length.to_bytes(2, "big")
+    return b"\xdd" + length.to_bytes(4, "big")
+
+
+def encode_chain(blocks: List[Block]) -> bytes:
+    """
+    Serializes list of blocks to msgpack
+    :param blocks: Block objects
+    """
+    return array_header(len(blocks)) + b"".join(encode_block(b) for b in blocks)
+
+
+def decode_chain(data: bytes) -> List[Block]:
+    """
+    Returns list of blocks from msgpack data
+    :param data: Encoded chain
+    """
+    return [block_from_list(b) for b in umsgpack.unpackb(data)]
+
+
+def dumps_block(block: Block, fmt: str = "json") -> Union[str, bytes]:
+    """
+    Serializes block in given format
+    :param block: Block object
+    :param fmt: "json" or "msgpack"
+    """
+    if fmt == "msgpack":
+        return encode_block(block)
+    return block.toJSON()
+
+
+def loads_block(data: Union[str, bytes]) -> Block:
+    """
+    Returns block from JSON string or msgpack bytes
+    :param data: Encoded block
+    """
+    from data_manipulation import fromJSON
+    if isinstance(data, bytes):
+        return decode_block(data)
+    return fromJSON(data)
+
+
+def dumps_transaction(transaction: Transaction, fmt: str = "json") -> Union[str, bytes]:
+    """
+    Serializes transaction in given format
+    :param transaction: Transaction object
+    :param fmt: "json" or "msgpack"
+    """
+    if fmt == "msgpack":
+        return encode_transaction(transaction)
+    return transaction.toJSON()
+
+
+def loads_transaction(data: Union[str, bytes]) -> Transaction:
+    """
+    Returns transaction from JSON string or msgpack bytes
+    :param data: Encoded transaction
+    """
+    from data_manipulation import transaction_fromJSON
+    if isinstance(data, bytes):
+        return decode_transaction(data)
+    return transaction_fromJSON(data)
+
+
+def compare_formats(blocks: List[Block], repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Compares size and speed of JSON and msgpack encodings of given blocks.
+    Times are the best of `repeat` runs, in seconds, bypassing cached block encodings.
+    :param blocks: Block objects
+    :param repeat: Number of timing runs
+    """
+    from data_manipulation import fromJSON
+
+    def best(function):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    encoded_json = json.dumps([b.toJSON() for b in blocks])
+    encoded_msgpack = encode_chain(blocks)
+    return {
+        "json": {
+            "bytes": len(encoded_json.encode()),
+            "encode": best(lambda: json.dumps([b._to_json() for b in blocks])),
+            "decode": best(lambda: [fromJSON(b) for b in json.loads(encoded_json)])
+        },
+        "msgpack": {
+            "bytes": len(encoded_msgpack),
+            "encode": best(lambda: umsgpack.packb([block_to_list(b) for b in blocks])),
+            "decode": best(lambda: decode_chain(encoded_msgpack))
+        }
+    }
@@ -0,0 +1,123 @@
+import json
+import threading
+import time
+from typing import Iterator, List, Tuple
+
+# Columns of the chain summary
+SUMMARY_FIELDS = ["block_id", "hash", "datetime", "transactions"]
+# Columns of the pending transactions view
+TRANSACTION_FIELDS = ["digest", "version", "filename", "file_hash", "signed", "manifest"]
+PAGE_SIZE = 50  # Rows per dashboard page
+
+
+def pages(total: int, per_page: int) -> int:
+    """
+    Returns number of pages needed for total rows, at least 1
+    :param total: Number of rows
+    :param per_page: Rows per page
+    """
+    return max(1, (total + per_page - 1) // per_page)
+
+
+class ChainSummary:
+    """
+    One row per block (ID, hash, time, number of transactions) for the dashboard.
+    Rows are built once and only rows of new blocks are added when the tip moves.
+    After a reorganization rows are dropped back to the fork point.
+    """
+
+    def __init__(self, blockchain):
+        """
+        ChainSummary class constructor
+        :param blockchain: Blockchain object to summarize
+        """
+
+        self.blockchain = blockchain
+        self.rows = []  # type: List[List]
+        self.version = 0  # Increased whenever rows are dropped
+        self.truncations = {}  # Version -> number of rows left when it was increased
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def row(block) -> List:
+        """
+        Returns summary row of a block
+        :param block: Block object
+        """
+        return [block.block_id, block.compute_hash(),
+                block.datetime.strftime("%d/%m/%Y, %H:%M:%S"), len(block.transactions)]
+
+    def refresh(self) -> int:
+        """
+        Brings rows up to date with the chain, returns number of rows added
+        """
+        with self._lock, self.blockchain.lock:
+            length = len(self.blockchain.chain)
+            count = len(self.rows)
+            # Drop rows of blocks no longer in the chain, checking from the tip down
+            while self.rows and (len(self.rows) > length
+                                 or self.rows[-1][1] != self.blockchain.block_hash(len(self.rows) - 1)):
+                self.rows.pop()
+            if len(self.rows) < count:
+                self.version += 1
+                self.truncations[self.version] = len(self.rows)
+            start = len(self.rows)
+            self.rows.extend(self.row(block) for block in self.blockchain.chain[start:])
+            return len(self.rows) - start
+
+    def page(self, page: int, per_page: int = PAGE_SIZE) -> Tuple[List[List], int]:
+        """
+        Returns rows of a page, newest blocks first, and the number of pages
+        :param page: Page number starting from 1
+        :param per_page: Rows per page
+        """
+        self.refresh()
+        rows = self.rows
+        total = pages(len(rows), per_page)
+        page = min(max(page, 1), total)
+        end = len(rows) - (page - 1) * per_page
+        return rows[max(end - per_page, 0):end][::-1], total
+
+    def events(self, interval: float = 1.0, keepalive: float = 15.0) -> Iterator[str]:
+        """
+        Yields server-sent events: "block" with the row of every new block
+        and "reorg" with the new height when blocks were replaced
+        :param interval: Seconds between chain checks
+        :param keepalive: Seconds between comments keeping the connection open
+        """
+        self.refresh()
+        sent, version = len(self.rows), self.version
+        quiet = 0.0
+        while True:
+            self.refresh()
+            if self.version != version:
+                # Resend rows from the lowest fork point since the last check
+                sent = min([sent] + [self.truncations[v] for v in range(version + 1, self.version + 1)])
+                version = self.version
+                yield f"event: reorg\ndata: {len(self.rows) - 1}\n\n"
+            if len(self.rows) > sent:
+                for row in self.rows[sent:]:
+                    yield f"event: block\ndata: {json.dumps(row)}\n\n"
+                sent = len(self.rows)
+                quiet = 0.0
+            elif quiet >= keepalive:
+                yield ": keepalive\n\n"
+                quiet = 0.0
+            time.sleep(interval)
+            quiet += interval
+
+
+def transaction_rows(mempool, page: int, per_page: int = PAGE_SIZE) -> Tuple[List[List], int]:
+    """
+    Returns rows of a page of pending transactions, oldest first, and the number of pages
+    :param mempool: Mempool object
+    :param page: Page number starting from 1
+    :param per_page: Rows per page
+    """
+    total = pages(len(mempool), per_page)
+    page = min(max(page, 1), total)
+    rows = []
+    for t in mempool.page((page - 1) * per_page, per_page):
+        rows.append([t.digest, t.version, t.filename, t.file_hash,
+                     "Signed" if t.is_signed else "Not signed", t.manifest])
+    return rows, total
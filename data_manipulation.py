@@ -1,10 +1,18 @@
 import json
 import requests
+import umsgpack
 from datetime import datetime
-from block import Block
+from typing import Iterable
+from block import DIFFICULTY, Block, header_hash, unpack_header
+from codec import block_from_list, decode_chain
+from keys import key_manager
+from merkle import verify_proof as verify_merkle_path
+from tracing import tracer
 from transaction import Transaction
+from trusted_keys import trusted_keys
 
 
+@tracer.trace()
 def fromJSON(block_json: str) -> Block:
     """
     Returns Block object from json data
@@ -25,7 +33,8 @@ def fromJSON(block_json: str) -> Block:
         block["block_id"],
         block["transactions"],
         block["datetime"],
-        block["prev_hash"]
+        block["prev_hash"],
+        block.get("merkle_root")
     )
     result_block.nonce = block["nonce"]
 
@@ -40,21 +49,165 @@ def transaction_fromJSON(t: str) -> Transaction:
     t = json.loads(t)
     pub_key = Transaction.denumerize_public_key(t['public_key'])
     new_transaction = Transaction(
-        pub_key, t['version'], t['file_hash'], t['filename'])
+        pub_key, t['version'], t['file_hash'], t['filename'], t.get('manifest'))
     if t['signature'] is not None:
         new_transaction.signature = b''.fromhex(t['signature'])
     return new_transaction
 
 
-def get_chain(ip: str) -> list:
+def get_chain(ip: str, fmt: str = "json") -> list:
     """
     Gets chain from blockchain node at ip address
     :param ip: IP address
+    :param fmt: Transfer format, "json" or "msgpack"
     """
-    data = {'action': 'get_chain'}
+    data = {'action': 'get_chain', 'format': fmt}
     r = requests.post(f'http://{ip}/rest/', json=data)
 
+    if fmt == "msgpack":
+        return decode_chain(r.content)
+
     data = r.json()
     chain = [fromJSON(b) for b in data]
 
     return chain
+
+
+SYNC_BATCH = 100  # Number of blocks requested per page during sync
+
+
+def get_blocks(ip: str, from_height: int, from_hash: str = None,
+               limit: int = SYNC_BATCH, fmt: str = "json") -> dict:
+    """
+    Gets a page of blocks from blockchain node at ip address.
+    Returns dict with keys: blocks, height (remote tip), fork.
+    Fork is True if the remote block before from_height has a different hash than from_hash.
+    :param ip: IP address
+    :param from_height: ID of the first block
+    :param from_hash: Hash of the local block preceding from_height
+    :param limit: Maximum number of blocks
+    :param fmt: Transfer format, "json" or "msgpack"
+    """
+    data = {'action': 'get_blocks', 'from_height': from_height,
+            'from_hash': from_hash, 'limit': limit, 'format': fmt}
+    r = requests.post(f'http://{ip}/rest/', json=data)
+
+    if fmt == "msgpack":
+        page = umsgpack.unpackb(r.content)
+        page["blocks"] = [block_from_list(b) for b in page["blocks"]]
+    else:
+        page = r.json()
+        page["blocks"] = [fromJSON(b) for b in page["blocks"]]
+    return page
+
+
+def sync_chain(ip: str, blockchain, batch_size: int = SYNC_BATCH, fmt: str = "json") -> int:
+    """
+    Downloads blocks missing from the local chain page by page.
+    Every page is validated before it is appended. If the chains forked,
+    the common ancestor is searched for and the local branch is replaced
+    only when the remote one is longer.
+    Returns number of appended blocks, -1 if received blocks are invalid.
+    :param ip: IP address
+    :param blockchain: Local Blockchain object
+    :param batch_size: Number of blocks per page
+    :param fmt: Transfer format, "json" or "msgpack"
+    """
+    # Look for the common ancestor, going back in growing steps
+    height = len(blockchain.chain)
+    step = 1
+    while True:
+        page = get_blocks(ip, height, blockchain.block_hash(height - 1), batch_size, fmt)
+        if not page["fork"]:
+            break
+        if height == 1:
+            return -1  # Different genesis block
+        height = max(1, height - step)
+        step *= 2
+
+    # Remote chain follows local tip, append page by page
+    if height == len(blockchain.chain):
+        appended = 0
+        while page["blocks"]:
+            if not blockchain.extend_chain(page["blocks"]):
+                return -1
+            appended += len(page["blocks"])
+            page = get_blocks(ip, len(blockchain.chain), blockchain.last_hash, batch_size, fmt)
+        return appended
+
+    # Remote branch has to be downloaded before the local one is dropped
+    branch = []
+    prev_hash = blockchain.block_hash(height - 1)
+    while page["blocks"]:
+        if not blockchain.validate_blocks(page["blocks"], prev_hash, height + len(branch)):
+            return -1
+        branch.extend(page["blocks"])
+        prev_hash = branch[-1].compute_hash()
+        page = get_blocks(ip, height + len(branch), prev_hash, batch_size, fmt)
+
+    with blockchain.lock:
+        if height + len(branch) <= len(blockchain.chain):
+            return 0
+        # Replaces local blocks after the fork point, puts them back if the branch doesn't fit
+        if blockchain.block_hash(height - 1) != branch[0].prev_hash \
+                or not blockchain.tree.switch(branch):
+            return -1
+    return len(branch)
+
+
+def get_proof(ip: str, file_hash: str, from_height: int = None) -> dict:
+    """
+    Gets inclusion proof of a firmware file from blockchain node at ip address
+    :param ip: IP address
+    :param file_hash: SHA256 hash of update file
+    :param from_height: First block header to download, e.g. the last one known to the device
+    """
+    data = {'action': 'get_proof', 'file_hash': file_hash, 'from_height': from_height}
+    r = requests.post(f'http://{ip}/rest/', json=data)
+    if r.status_code != 200:
+        return None
+    return r.json()
+
+
+def verify_proof(proof: dict, file_hash: str, trusted_hash: str,
+                 trusted: Iterable[str] = None, difficulty: int = DIFFICULTY) -> bool:
+    """
+    Verifies that a transaction with given file hash, signed by a trusted author,
+    is included in the chain. Only needs the proof, not the chain itself.
+    :param proof: Proof returned by get_proof
+    :param file_hash: SHA256 hash of update file
+    :param trusted_hash: Hash of the block before the first header, known to the device.
+    "0" * 64 for proofs starting at the genesis block.
+    :param trusted: Fingerprints of trusted authors, the trusted keys registry by default
+    :param difficulty: Number of leading zeros required in block hashes
+    """
+    headers = [unpack_header(bytes.fromhex(h)) for h in proof["headers"]]
+    hashes = [header_hash(bytes.fromhex(h)) for h in proof["headers"]]
+    if not headers:
+        return False
+
+    # Header chain, anchored to a block the verifier already trusts
+    if headers[0]["prev_hash"] != trusted_hash:
+        return False
+    for i, header in enumerate(headers):
+        if header["block_id"] != proof["from_height"] + i:
+            return False
+        if not hashes[i].startswith('0' * difficulty):
+            return False
+        if i > 0 and header["prev_hash"] != hashes[i - 1]:
+            return False
+
+    # Transaction
+    position = proof["block_id"] - proof["from_height"]
+    if not 0 <= position < len(headers):
+        return False
+    transaction = transaction_fromJSON(proof["transaction"])
+    if transaction.file_hash != file_hash or not transaction.verify():
+        return False
+    # Anyone can sign, only trusted authors count
+    if trusted is not None:
+        if key_manager.fingerprint(transaction.public_key) not in set(trusted):
+            return False
+    elif not trusted_keys.admits(transaction.public_key):
+        return False
+    return verify_merkle_path(transaction.digest, proof["path"], headers[position]["merkle_root"])
@@ -0,0 +1,114 @@
+import hashlib
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Tuple
+
+
+def sha256_file(path: str, chunk_size: int = 8 * 1024 * 1024,
+                mmap_threshold: int = 64 * 1024 * 1024) -> str:
+    """
+    Returns hex SHA256 of a file.
+    Large files are hashed from a mmap in one call, others are read in large chunks
+    into a reused buffer. hashlib releases the GIL, so files hash in parallel on threads.
+    :param path: Path to the file
+    :param chunk_size: Bytes read at once
+    :param mmap_threshold: Files at least this big are mapped instead of read
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= mmap_threshold:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                h.update(mapped)
+        else:
+            buffer = bytearray(min(chunk_size, max(size, 1)))
+            view = memoryview(buffer)
+            while True:
+                n = f.readinto(buffer)
+                if not n:
+                    break
+                h.update(view[:n])
+    return h.hexdigest()
+
+
+def file_key(path: str) -> Tuple[str, int, int]:
+    """
+    Returns cache key of a file's contents: absolute path, size and modification time
+    :param path: Path to the file
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+
+class FirmwareHasher:
+    """
+    Computes SHA256 of firmware images.
+    Results are cached by path, size and modification time, so unchanged files
+    are never read twice.
+    """
+    CACHE_SIZE = 1024  # Number of remembered file hashes
+
+    def __init__(self, workers: int = None):
+        """
+        FirmwareHasher class constructor
+        :param workers: Number of threads hashing files at once, defaults to CPU count
+        """
+
+        self.workers = workers or os.cpu_count() or 1
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()  # type: OrderedDict[Tuple[str, int, int], str]
+        self._lock = threading.Lock()
+
+    def hash_file(self, path: str) -> str:
+        """
+        Returns hex SHA256 of a file, from cache if it didn't change
+        :param path: Path to the file
+        """
+        key = file_key(path)
+        with self._lock:
+            digest = self._cache.get(key)
+            if digest is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return digest
+            self.misses += 1
+
+        digest = sha256_file(path)
+        with self._lock:
+            self._cache[key] = digest
+            if len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return digest
+
+    def hash_files(self, paths: Iterable[str]) -> Dict[str, str]:
+        """
+        Returns hashes of many files computed concurrently
+        :param paths: Paths to the files
+        """
+        paths = list(paths)
+        if len(paths) <= 1:
+            return {p: self.hash_file(p) for p in paths}
+        with ThreadPoolExecutor(min(self.workers, len(paths))) as pool:
+            return dict(zip(paths, pool.map(self.hash_file, paths)))
+
+    def clear(self):
+        """
+        Forgets all cached hashes
+        """
+        with self._lock:
+            self._cache.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns cache hits, misses and size
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
+
+
+# Shared by the blockchain, console and REST API
+firmware_hasher = FirmwareHasher()
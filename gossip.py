@@ -0,0 +1,167 @@
+import hashlib
+import math
+import threading
+from typing import Callable, List
+
+
+class BloomFilter:
+    """
+    Fixed size set of strings with false positives but no false negatives
+    """
+
+    def __init__(self, capacity: int, error_rate: float):
+        """
+        BloomFilter class constructor
+        :param capacity: Expected number of items
+        :param error_rate: False positive probability at full capacity
+        """
+
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str):
+        digest = hashlib.sha256(key.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:16], "big") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key: str):
+        """
+        Adds key to the filter
+        :param key: Any string, e.g. transaction digest
+        """
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+class RotatingBloomFilter:
+    """
+    Bloom filter forgetting old items: when the current filter is full
+    it becomes the previous one and a new filter is started.
+    Remembers between `capacity` and 2 * `capacity` most recent items.
+    """
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.001):
+        """
+        RotatingBloomFilter class constructor
+        :param capacity: Number of items per filter
+        :param error_rate: False positive probability of a single filter
+        """
+
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = BloomFilter(capacity, error_rate)
+
+    def add(self, key: str):
+        """
+        Adds key, rotating filters if the current one is full
+        :param key: Any string, e.g. transaction digest
+        """
+        if self._current.count >= self.capacity:
+            self._previous = self._current
+            self._current = BloomFilter(self.capacity, self.error_rate)
+        self._current.add(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._current or key in self._previous
+
+
+class Gossip:
+    """
+    Relays transactions to peers in batches and only once per transaction.
+    Queued transactions are sent as one multi-packet message when the batch is full
+    or after a short delay.
+    """
+    BATCH_SIZE = 50  # Transactions per message
+    INTERVAL = 0.2  # Seconds a transaction may wait for a batch
+
+    def __init__(self, send: Callable[[List], None], seen_capacity: int = 100000):
+        """
+        Gossip class constructor
+        :param send: Function sending a list of encoded transactions as one message
+        :param seen_capacity: Number of transaction digests remembered per filter
+        """
+
+        self.send = send
+        self.seen = RotatingBloomFilter(seen_capacity)
+        self.messages_sent = 0
+        self.transactions_sent = 0
+        self.suppressed = 0  # Transactions not relayed because they were seen before
+        self._outbox = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def is_new(self, digest: str) -> bool:
+        """
+        Returns False if transaction was already relayed or received, counting it as suppressed
+        :param digest: Transaction digest
+        """
+        if digest in self.seen:
+            with self._lock:
+                self.suppressed += 1
+            return False
+        return True
+
+    def relay(self, payload, digest: str) -> bool:
+        """
+        Queues transaction for sending unless it was relayed before
+        :param payload: Encoded transaction
+        :param digest: Transaction digest
+        """
+        with self._lock:
+            if digest in self.seen:
+                self.suppressed += 1
+                return False
+            self.seen.add(digest)
+            self._outbox.append(payload)
+
+            if len(self._outbox) >= self.BATCH_SIZE:
+                batch = self._take()
+            else:
+                batch = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.INTERVAL, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if batch:
+            self._send(batch)
+        return True
+
+    def _take(self) -> list:
+        batch, self._outbox = self._outbox, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return batch
+
+    def _send(self, batch: list):
+        self.send(batch)
+        with self._lock:
+            self.messages_sent += 1
+            self.transactions_sent += len(batch)
+
+    def flush(self):
+        """
+        Sends all queued transactions now
+        """
+        with self._lock:
+            batch = self._take()
+        if batch:
+            self._send(batch)
+
+    @property
+    def stats(self) -> dict:
+        """
+        Returns gossip counters
+        """
+        return {"messages_sent": self.messages_sent,
+                "transactions_sent": self.transactions_sent,
+                "suppressed": self.suppressed,
+                "queued": len(self._outbox)}
@@ -0,0 +1,205 @@
+import hashlib
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.backends.openssl.rsa import (_RSAPrivateKey,
+                                                      _RSAPublicKey)
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicNumbers
+
+
+class KeyManager:
+    """
+    Loads node keys once and caches serialized forms of public keys
+    """
+    RELOAD_INTERVAL = 5.0  # Minimum seconds between key file change checks
+    MAX_FOREIGN_KEYS = 10000  # Number of deserialized authors' keys kept
+
+    def __init__(self, private_path: str = "private_key.pem", public_path: str = "public_key.pem"):
+        """
+        KeyManager class constructor
+        :param private_path: Path of the PEM encoded private key
+        :param public_path: Path of the PEM encoded public key
+        """
+
+        self.private_path = private_path
+        self.public_path = public_path
+        self._private_key = None
+        self._public_key = None
+        self._mtimes = None
+        self._checked = 0.0
+        self._lock = threading.RLock()
+
+        self._pem = weakref.WeakKeyDictionary()  # Public key -> PEM bytes
+        self._numeric = weakref.WeakKeyDictionary()  # Public key -> "n|e"
+        self._fingerprints = weakref.WeakKeyDictionary()  # Public key -> SHA256 hex
+        self._keys = OrderedDict()  # (n, e) -> public key
+
+    @classmethod
+    def generate_private_key(cls) -> _RSAPrivateKey:
+        """
+        Generates private key
+        """
+        return rsa.generate_private_key(
+            public_exponent=65537,
+            key_size=2048,
+            backend=default_backend()
+        )
+
+    def ensure_keys(self):
+        """
+        Generates private key and public key if not found
+        """
+        with self._lock:
+            if os.path.exists(self.private_path) and os.path.exists(self.public_path):
+                return
+
+            private_key = self.generate_private_key()
+            public_key = private_key.public_key()
+
+            public_pem = public_key.public_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo
+            )
+
+            private_pem = private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            )
+
+            with open(self.public_path, 'wb') as f:
+                f.write(public_pem)
+
+            with open(self.private_path, 'wb') as f:
+                f.write(private_pem)
+
+            self._private_key = None
+            self._public_key = None
+
+    def _file_mtimes(self):
+        return (os.stat(self.private_path).st_mtime_ns,
+                os.stat(self.public_path).st_mtime_ns)
+
+    def _load(self):
+        """
+        Loads keys from disk if not loaded yet or if files changed.
+        Files are checked at most every RELOAD_INTERVAL seconds.
+        """
+        now = time.monotonic()
+        if self._private_key is not None and now - self._checked < self.RELOAD_INTERVAL:
+            return
+        with self._lock:
+            self._checked = now
+            mtimes = self._file_mtimes()
+            if self._private_key is not None and mtimes == self._mtimes:
+                return
+            self.reload()
+
+    def reload(self):
+        """
+        Reads both key files from disk
+        """
+        with self._lock:
+            with open(self.private_path, "rb") as private_key_file:
+                self._private_key = serialization.load_pem_private_key(
+                    private_key_file.read(),
+                    password=None,
+                    backend=default_backend()
+                )
+            with open(self.public_path, "rb") as key_file:
+                self._public_key = serialization.load_pem_public_key(
+                    key_file.read(),
+                    backend=default_backend()
+                )
+            self._mtimes = self._file_mtimes()
+            self._checked = time.monotonic()
+
+    @property
+    def private_key(self) -> _RSAPrivateKey:
+        """
+        Returns node's private key object
+        """
+        self._load()
+        return self._private_key
+
+    @property
+    def public_key(self) -> _RSAPublicKey:
+        """
+        Returns node's public key object
+        """
+        self._load()
+        return self._public_key
+
+    def public_bytes(self, key: _RSAPublicKey) -> bytes:
+        """
+        Returns PEM encoded public key, cached per key object
+        :param key: Public key object
+        """
+        pem = self._pem.get(key)
+        if pem is None:
+            pem = key.public_bytes(
+                serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+            self._pem[key] = pem
+        return pem
+
+    def numerize(self, key: _RSAPublicKey) -> str:
+        """
+        Returns public key in a numeric "n|e" format, cached per key object
+        :param key: Public key object
+        """
+        numeric = self._numeric.get(key)
+        if numeric is None:
+            numbers = key.public_numbers()
+            numeric = f"{numbers.n}|{numbers.e}"
+            self._numeric[key] = numeric
+        return numeric
+
+    def fingerprint(self, key: _RSAPublicKey) -> str:
+        """
+        Returns SHA256 of the DER encoded public key as hex, cached per key object
+        :param key: Public key object
+        """
+        fingerprint = self._fingerprints.get(key)
+        if fingerprint is None:
+            der = key.public_bytes(
+                serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+            fingerprint = hashlib.sha256(der).hexdigest()
+            self._fingerprints[key] = fingerprint
+        return fingerprint
+
+    def denumerize(self, key_numeric: str) -> _RSAPublicKey:
+        """
+        Returns public key from a numeric format.
+        :param key_numeric: Public key in "n|e" format
+        """
+        n, e = key_numeric.split('|')
+        return self.from_numbers(int(n), int(e))
+
+    def from_numbers(self, n: int, e: int) -> _RSAPublicKey:
+        """
+        Returns public key from its modulus and exponent.
+        The same key object is returned for the same author, so its serialized forms stay cached.
+        :param n: Modulus
+        :param e: Public exponent
+        """
+        with self._lock:
+            key = self._keys.get((n, e))
+            if key is not None:
+                self._keys.move_to_end((n, e))
+                return key
+
+            key = RSAPublicNumbers(e, n).public_key(default_backend())
+            self._keys[(n, e)] = key
+            if len(self._keys) > self.MAX_FOREIGN_KEYS:
+                self._keys.popitem(last=False)
+            return key
+
+
+# Key manager shared by the blockchain, transactions and serialization
+key_manager = KeyManager()
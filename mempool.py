@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+from itertools import islice
+from typing import Iterable, Iterator, List, Union
+
+from transaction import Transaction
+
+
+class Mempool:
+    """
+    Pending transactions keyed by transaction digest, kept in arrival order.
+    When full, the oldest transactions are evicted first.
+    """
+
+    def __init__(self, max_count: int = 10000, max_bytes: int = 16 * 1024 * 1024):
+        """
+        Mempool class constructor
+        :param max_count: Maximum number of pending transactions
+        :param max_bytes: Maximum total size of serialized pending transactions
+        """
+
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.evicted = 0  # Number of transactions dropped because of the limits
+        self._transactions = OrderedDict()  # Digest -> transaction
+        self._sizes = {}  # Digest -> serialized size
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def add(self, transaction: Transaction) -> bool:
+        """
+        Adds transaction, returns False if it is already pending
+        :param transaction: Transaction object
+        """
+        digest = transaction.digest
+        size = len(transaction.toJSON())
+        with self._lock:
+            if digest in self._transactions:
+                return False
+            self._transactions[digest] = transaction
+            self._sizes[digest] = size
+            self._bytes += size
+
+            while len(self._transactions) > self.max_count or self._bytes > self.max_bytes:
+                oldest, _ = self._transactions.popitem(last=False)
+                self._bytes -= self._sizes.pop(oldest)
+                self.evicted += 1
+            return digest in self._transactions
+
+    def _pop(self, digest: str) -> bool:
+        if self._transactions.pop(digest, None) is None:
+            return False
+        self._bytes -= self._sizes.pop(digest)
+        return True
+
+    def remove(self, transaction: Union[Transaction, str]) -> bool:
+        """
+        Removes transaction, returns False if it wasn't pending
+        :param transaction: Transaction object or its digest
+        """
+        digest = transaction if isinstance(transaction, str) else transaction.digest
+        with self._lock:
+            return self._pop(digest)
+
+    def remove_many(self, transactions: Iterable[Transaction]) -> int:
+        """
+        Removes all given transactions, e.g. the ones included in a block.
+        Returns number of removed transactions.
+        :param transactions: Transaction objects
+        """
+        digests = [t.digest for t in transactions]
+        with self._lock:
+            return sum(self._pop(digest) for digest in digests)
+
+    def peek(self, count: int = None) -> List[Transaction]:
+        """
+        Returns up to count oldest transactions without removing them,
+        they leave the mempool when a block including them is added
+        :param count: Maximum number of transactions, all if None
+        """
+        with self._lock:
+            return list(islice(self._transactions.values(), count))
+
+    def page(self, start: int, count: int) -> List[Transaction]:
+        """
+        Returns count transactions from given position in arrival order,
+        without copying the rest of the pool
+        :param start: Position of the first transaction
+        :param count: Maximum number of transactions
+        """
+        with self._lock:
+            return list(islice(self._transactions.values(), start, start + count))
+
+    def clear(self):
+        """
+        Removes all pending transactions
+        """
+        with self._lock:
+            self._transactions.clear()
+            self._sizes.clear()
+            self._bytes = 0
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Returns total size of serialized pending transactions
+        """
+        return self._bytes
+
+    def __contains__(self, transaction: Union[Transaction, str]) -> bool:
+        digest = transaction if isinstance(transaction, str) else transaction.digest
+        return digest in self._transactions
+
+    def __len__(self):
+        return len(self._transactions)
+
+    def __iter__(self) -> Iterator[Transaction]:
+        return iter(self.peek())
+
+    def __repr__(self):
+        return f"Mempool({len(self)} transactions, {self._bytes} bytes)"
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import os
+from collections import deque
+from typing import Iterable, List, Tuple
+
+EMPTY_ROOT = "0" * 64  # Root of a tree without leaves
+
+
+def hash_pair(left: str, right: str) -> str:
+    """
+    Returns hash of two child nodes
+    :param left: Hex digest of the left node
+    :param right: Hex digest of the right node
+    """
+    return hashlib.sha256(b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def merkle_root(leaves: List[str]) -> str:
+    """
+    Returns merkle root of hex digests.
+    A node without a pair is promoted to the next level unchanged.
+    :param leaves: List of hex digests
+    """
+    if not leaves:
+        return EMPTY_ROOT
+
+    level = list(leaves)
+    while len(level) > 1:
+        next_level = [hash_pair(level[i], level[i + 1])
+                      for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+    return level[0]
+
+
+def merkle_proof(leaves: List[str], index: int) -> List[Tuple[str, str]]:
+    """
+    Returns path from a leaf to the root as (side, sibling) pairs,
+    where side tells if the sibling is on the "L"eft or "R"ight.
+    Levels where the node is promoted without a pair are skipped.
+    :param leaves: List of hex digests
+    :param index: Position of the leaf
+    """
+    path = []
+    level = list(leaves)
+    while len(level) > 1:
+        if index % 2:
+            path.append(("L", level[index - 1]))
+        elif index + 1 < len(level):
+            path.append(("R", level[index + 1]))
+        next_level = [hash_pair(level[i], level[i + 1])
+                      for i in range(0, len(level) - 1, 2)]
+        if len(level) % 2:
+            next_level.append(level[-1])
+        level = next_level
+        index //= 2
+    return path
+
+
+def verify_proof(leaf: str, path: List[Tuple[str, str]], root: str) -> bool:
+    """
+    Checks if leaf is included in a tree with given root
+    :param leaf: Hex digest
+    :param path: Path returned by merkle_proof
+    :param root: Expected merkle root
+    """
+    node = leaf
+    for side, sibling in path:
+        node = hash_pair(sibling, node) if side == "L" else hash_pair(node, sibling)
+    return node == root
+
+
+class MerkleAccumulator:
+    """
+    Append-only merkle tree which keeps only the roots of its full subtrees.
+    Appending a leaf and computing the root take O(log n).
+    The root equals merkle_root() of all appended leaves.
+    Frontiers of the last HISTORY sizes are kept, so dropping recent leaves
+    doesn't need the tree to be rebuilt.
+    """
+    HISTORY = 256  # Number of recent frontiers kept for truncate
+
+    def __init__(self, path: str = None):
+        """
+        MerkleAccumulator class constructor
+        :param path: File the frontier is saved to by save(), kept in memory only if None
+        """
+
+        self.path = path
+        self.count = 0
+        self.last_leaf = None
+        self.frontier = []  # type: List[str]  # Root of a full subtree of 2**level leaves or None
+        self._root = EMPTY_ROOT
+        self._history = deque(maxlen=self.HISTORY)  # (count, last leaf, frontier) after recent appends
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def append(self, leaf: str):
+        """
+        Adds leaf to the tree
+        :param leaf: Hex digest
+        """
+        node = leaf
+        level = 0
+        while level < len(self.frontier) and self.frontier[level] is not None:
+            node = hash_pair(self.frontier[level], node)
+            self.frontier[level] = None
+            level += 1
+        if level == len(self.frontier):
+            self.frontier.append(node)
+        else:
+            self.frontier[level] = node
+
+        self.count += 1
+        self.last_leaf = leaf
+        self._root = None
+        self._history.append((self.count, leaf, tuple(self.frontier)))
+
+    def truncate(self, count: int) -> bool:
+        """
+        Drops leaves after the first count ones, in O(log n) if they were appended recently.
+        Returns False if the tree has to be rebuilt instead.
+        :param count: Number of leaves to keep
+        """
+        if count == self.count:
+            return True
+        while self._history and self._history[-1][0] > count:
+            self._history.pop()
+        if count == 0:
+            self.count, self.last_leaf, self.frontier, self._root = 0, None, [], EMPTY_ROOT
+            return True
+        if not self._history or self._history[-1][0] != count:
+            self._history.clear()
+            return False
+        self.count, self.last_leaf, frontier = self._history[-1]
+        self.frontier = list(frontier)
+        self._root = None
+        return True
+
+    def rebuild(self, leaves: Iterable[str]):
+        """
+        Replaces the tree with one built from given leaves
+        :param leaves: Hex digests
+        """
+        self.count = 0
+        self.last_leaf = None
+        self.frontier = []
+        self._root = EMPTY_ROOT
+        self._history.clear()
+        for leaf in leaves:
+            self.append(leaf)
+        self.save()
+
+    @property
+    def root(self) -> str:
+        """
+        Returns merkle root of all appended leaves
+        """
+        if self._root is None:
+            root = None
+            for node in self.frontier:
+                if node is not None:
+                    root = node if root is None else hash_pair(node, root)
+            self._root = root
+        return self._root
+
+    def save(self):
+        """
+        Writes the frontier to file, if it has one
+        """
+        if self.path is None:
+            return
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"count": self.count,
+                       "last_leaf": self.last_leaf,
+                       "frontier": self.frontier}, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """
+        Reads the frontier from file
+        """
+        with open(self.path, "r") as f:
+            data = json.load(f)
+        self.count = data["count"]
+        self.last_leaf = data["last_leaf"]
+        self.frontier = data["frontier"]
+        self._root = None
+        self._history.clear()
@@ -0,0 +1,238 @@
+import bisect
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# Latency buckets in seconds, from 100 microseconds to 1 minute
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+class Registry:
+    """
+    Collection of metrics rendered in the Prometheus text format.
+    While disabled every update returns immediately, so instrumented code pays
+    a single attribute check.
+    """
+
+    def __init__(self, enabled: bool = False):
+        """
+        Registry class constructor
+        :param enabled: Whether metrics are collected
+        """
+
+        self.enabled = enabled
+        self.metrics = []  # type: List[_Metric]
+
+    def register(self, metric: "_Metric") -> "_Metric":
+        """
+        Adds metric to the rendered ones
+        :param metric: Counter, Gauge or Histogram
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+def _labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, registry: Registry, name: str, help: str, labels: Sequence[str] = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._values = {}  # Label values -> value
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+                for key, value in sorted(self._values.items())]
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing value, e.g. number of handled messages
+    """
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        """
+        Increases counter
+        :param amount: Value to add
+        :param labels: Label values
+        """
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    Value going up and down, set directly or read from a function when scraped
+    """
+    type = "gauge"
+
+    def __init__(self, registry: Registry, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(registry, name, help, labels)
+        self._functions = {}  # Label values -> function returning the value
+
+    def set(self, value: float, **labels):
+        """
+        Sets gauge value
+        :param value: New value
+        :param labels: Label values
+        """
+        if not self.registry.enabled:
+            return
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels):
+        """
+        Reads value from a function when metrics are rendered, costing nothing in between
+        :param function: Function returning current value
+        :param labels: Label values
+        """
+        self._functions[self._key(labels)] = function
+
+    def samples(self) -> List[str]:
+        values = dict(self._values)
+        for key, function in list(self._functions.items()):
+            try:
+                values[key] = function()
+            except Exception:
+                continue
+        return [f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+                for key, value in sorted(values.items())]
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, histogram: "Histogram", labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values in cumulative buckets, with their sum and count
+    """
+    type = "histogram"
+
+    def __init__(self, registry: Registry, name: str, help: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        """
+        Records a value
+        :param value: Observed value, e.g. duration in seconds
+        :param labels: Label values
+        """
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per bucket counts, +Inf last, then sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """
+        Returns context manager observing duration of its block in seconds
+        :param labels: Label values
+        """
+        if not self.registry.enabled:
+            return _NULL_TIMER
+        return _Timer(self, labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            items = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = _labels(self.label_names, key, f'le="{_number(bound)}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+
+# Enabled with FIRMWARECHAIN_METRICS=1
+registry = Registry(os.environ.get("FIRMWARECHAIN_METRICS", "") not in ("", "0"))
+
+pow_attempts = Counter(registry, "firmwarechain_pow_attempts_total",
+                       "Nonces tried while mining")
+pow_seconds = Histogram(registry, "firmwarechain_pow_seconds",
+                        "Duration of proof of work", buckets=LATENCY_BUCKETS + (300.0, 900.0))
+verify_seconds = Histogram(registry, "firmwarechain_verify_seconds",
+                           "Duration of verification", ["kind"])
+message_seconds = Histogram(registry, "firmwarechain_message_seconds",
+                            "Duration of incoming message handling", ["type", "stage"])
+messages = Counter(registry, "firmwarechain_messages_total",
+                   "Incoming messages", ["type"])
+chain_height = Gauge(registry, "firmwarechain_chain_height", "ID of the last block")
+mempool_size = Gauge(registry, "firmwarechain_mempool_transactions", "Pending transactions")
+queue_depth = Gauge(registry, "firmwarechain_pipeline_depth",
+                    "Messages waiting in the ingest pipeline")
+sync_blocks = Counter(registry, "firmwarechain_sync_blocks_total",
+                      "Blocks downloaded by headers-first sync", ["peer"])
+sync_bytes = Counter(registry, "firmwarechain_sync_bytes_total",
+                     "Bytes of blocks downloaded by headers-first sync", ["peer"])
+sync_seconds = Counter(registry, "firmwarechain_sync_seconds_total",
+                       "Time spent waiting for block bodies", ["peer"])
@@ -0,0 +1,178 @@
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Optional, Tuple
+
+from block import NONCE_FORMAT, Block
+import metrics
+from tracing import tracer
+
+MAX_NONCE = 2 ** 64  # Nonce is stored as unsigned 64-bit integer in the header
+# Workers are started from a clean process, not forked from the node's threads and locks
+START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+# Set in every worker process by _init_worker
+_cancel_event = None
+
+
+def _init_worker(cancel_event):
+    """
+    Stores the shared cancellation event in the worker process
+    :param cancel_event: multiprocessing.Event set when mining should stop
+    """
+    global _cancel_event
+    _cancel_event = cancel_event
+
+
+def _search(header_prefix: bytes, target: str, start: int, stop: int) -> Optional[int]:
+    """
+    Searches nonces in range [start, stop) for a header hash with the target prefix.
+    The constant header part is hashed once, every attempt only hashes the nonce.
+    Returns the nonce or None if not found or cancelled.
+    """
+    midstate = hashlib.sha256(header_prefix)
+    pack = NONCE_FORMAT.pack
+    for nonce in range(start, min(stop, MAX_NONCE)):
+        if nonce & 0xfff == 0 and _cancel_event.is_set():
+            return None
+        sha = midstate.copy()
+        sha.update(pack(nonce))
+        if sha.hexdigest().startswith(target):
+            return nonce
+    return None
+
+
+class Miner:
+    """
+    Proof of Work miner splitting the nonce space across a process pool
+    """
+    CHUNK_SIZE = 50000  # Nonces checked by a worker per task
+
+    def __init__(self, workers: int = None):
+        """
+        Miner class constructor
+        :param workers: Number of worker processes, defaults to CPU count
+        """
+
+        self.workers = workers or os.cpu_count() or 1
+        self.height = None  # ID of the block being mined
+        self._context = multiprocessing.get_context(START_METHOD)
+        self._cancel = self._context.Event()
+        self._pool = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        """
+        Returns worker pool, starting it on first use
+        """
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=self._context,
+                initializer=_init_worker,
+                initargs=(self._cancel,)
+            )
+        return self._pool
+
+    @tracer.trace()
+    def mine(self, block: Block, difficulty: int) -> Optional[Tuple[Block, str]]:
+        """
+        Looks for a nonce giving a hash with a proper number of leading zeros.
+        Returns block with nonce set and its hash, or None if cancelled.
+        :param block: Block object to mine
+        :param difficulty: Number of leading zeros required in hash
+        """
+
+        target = '0' * difficulty
+        prefix = block.header_prefix
+        self._cancel.clear()
+        self.height = block.block_id
+        try:
+            with metrics.pow_seconds.time():
+                if self.workers == 1:
+                    nonce = self._mine_serial(prefix, target, block.nonce)
+                else:
+                    nonce = self._mine_parallel(prefix, target, block.nonce)
+        finally:
+            self.height = None
+
+        if nonce is None:
+            return None
+        # Approximate, other workers also searched ranges below the nonce
+        metrics.pow_attempts.inc(nonce - block.nonce + 1)
+        block.nonce = nonce
+        return block, block.compute_hash()
+
+    def _mine_serial(self, prefix: bytes, target: str, start: int) -> Optional[int]:
+        """
+        Searches nonce space chunk by chunk in the current process
+        """
+        _init_worker(self._cancel)
+        while not self._cancel.is_set() and start < MAX_NONCE:
+            nonce = _search(prefix, target, start, start + self.CHUNK_SIZE)
+            if nonce is not None:
+                return nonce
+            start += self.CHUNK_SIZE
+        return None
+
+    def _mine_parallel(self, prefix: bytes, target: str, start: int) -> Optional[int]:
+        """
+        Keeps every worker busy with consecutive nonce ranges until one finds a hash
+        """
+        pending = set()
+        found = None
+
+        def submit():
+            nonlocal start
+            if start >= MAX_NONCE:
+                return
+            pending.add(self.pool.submit(
+                _search, prefix, target, start, start + self.CHUNK_SIZE))
+            start += self.CHUNK_SIZE
+
+        for _ in range(self.workers * 2):
+            submit()
+
+        try:
+            while pending and found is None and not self._cancel.is_set():
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    nonce = future.result()
+                    if nonce is not None and (found is None or nonce < found):
+                        found = nonce
+                if found is None and not self._cancel.is_set():
+                    for _ in done:
+                        submit()
+        finally:
+            # Stop workers still searching
+            self._cancel.set()
+            for future in pending:
+                future.cancel()
+        return found
+
+    def cancel(self):
+        """
+        Stops current mining
+        """
+        self._cancel.set()
+
+    def cancel_height(self, block_id: int) -> bool:
+        """
+        Stops mining if a block with the same or higher ID arrived.
+        Returns True if mining was cancelled.
+        :param block_id: ID of the received block
+        """
+        if self.height is not None and block_id >= self.height:
+            self.cancel()
+            return True
+        return False
+
+    def close(self):
+        """
+        Cancels mining and shuts the worker pool down
+        """
+        self.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
@@ -1,17 +1,35 @@
 #!/usr/bin/env python3
+import json
+import os
 import sys
+from collections import OrderedDict
 
 import py2p
+from py2p import flags
 
+from blob_store import BlobStore, ChunkFetcher, encode_manifest, is_hash
 from blockchain import Blockchain
+from chain_store import ChainStore
+from codec import FORMATS, compare_formats, encode_block, loads_block, loads_transaction
+from data_manipulation import verify_proof
+from keys import key_manager
+import metrics
+from pipeline import Pipeline
+from signature_cache import signature_cache
+from sync import HeaderSync
+from tracing import tracer
 from transaction import Transaction
-from data_manipulation import transaction_fromJSON, fromJSON
+from trusted_keys import trusted_keys
+from verification import batch_verifier
 
 
 def exit_function():
     """
     Close connection safely and exit
     """
+    node.pipeline.close()
+    node.bc.close()
+    batch_verifier.close()
     node.sock.close()
     exit()
 
@@ -20,15 +38,23 @@ class Node:
     """
     Combining blockchain with secure P2P connectivity
     """
+    MAX_PROOFS = 100  # Received proofs and pending proof requests kept, oldest dropped first
 
-    def __init__(self, port=4444):
+    def __init__(self, port=4444, data_dir=None, wire_format="json", blob_dir=None):
         """
         Initialize node.
         :param port: Port on which the node's socket will be operating
+        :param data_dir: Directory of the block store, chain is kept in memory only if None
+        :param wire_format: Format of sent blocks and transactions, "json" or "msgpack".
+            Both formats are accepted from peers.
+        :param blob_dir: Directory of the firmware blob store, data_dir/blobs by default.
+            Firmware files are not shared if neither is given.
         """
         self.sock = py2p.MeshSocket(
             '0.0.0.0', port, py2p.Protocol('mesh', 'SSL'))
-        self.bc = Blockchain(self.sock)
+        store = ChainStore(data_dir) if data_dir is not None else None
+        self.bc = Blockchain(self.sock, store)
+        self.bc.wire_format = wire_format
         self.sock.register_handler(self.handle_incoming)
 
         # Attach listener to connection event
@@ -37,50 +63,186 @@ class Node:
 
         self.longest_chain = 1
         self.longest_chain_owner = None
+        self.proofs = OrderedDict()  # File hash -> (proof, is valid) received from peers
+        self.proof_requests = OrderedDict()  # File hash -> None, proofs asked for with get_proof
+        self.sync = HeaderSync(self.bc, self.send_to,
+                               lambda: list(self.sock.routing_table))
+        if blob_dir is None and data_dir is not None:
+            blob_dir = os.path.join(data_dir, "blobs")
+        self.blobs = BlobStore(blob_dir) if blob_dir is not None else None
+        self.fetcher = ChunkFetcher(self.blobs, self.send_to,
+                                    lambda: list(self.sock.routing_table)) if self.blobs else None
+        # Messages are processed off the network thread, changes applied under the chain lock
+        self.pipeline = Pipeline(self.prepare, lock=self.bc.lock)
+
+        # Read when metrics are scraped
+        metrics.chain_height.set_function(lambda: len(self.bc.chain) - 1)
+        metrics.mempool_size.set_function(lambda: len(self.bc.pending_transactions))
+        metrics.queue_depth.set_function(lambda: self.pipeline.depth)
+
+    def request_proof(self, file_hash: str):
+        """
+        Asks peers for an inclusion proof of a firmware file, only requested proofs are accepted
+        :param file_hash: Hash of the firmware file
+        """
+        self.proof_requests[file_hash] = None
+        self.proof_requests.move_to_end(file_hash)
+        while len(self.proof_requests) > self.MAX_PROOFS:
+            self.proof_requests.popitem(last=False)
+        self.sock.send(file_hash, type='get_proof')
+
+    def send_to(self, peer_id: bytes, msg_type: str, *packets):
+        """
+        Sends message to a single directly connected peer
+        :param peer_id: ID of the peer
+        :param msg_type: Message type, received as the first packet
+        :param packets: Message packets
+        """
+        handler = self.sock.routing_table.get(peer_id)
+        if handler is not None:
+            handler.send(flags.whisper, msg_type, *packets)
 
     def handle_incoming(self, msg: py2p.base.Message, handler):
         """
-        Handles incoming messages
+        Queues incoming messages for the pipeline, never blocks the network thread
         :param msg: Incoming message
         :param handler: Handler function
         """
 
-        print(msg.packets)  # todo del after dev
+        if not self.pipeline.submit(msg.packets[0], msg):
+            print(bcolors.WARNING + f"Dropped {msg.packets[0]}, node overloaded" + bcolors.ENDC)
+
+    def prepare(self, msg: py2p.base.Message):
+        """
+        Parses and verifies a message on a pipeline worker.
+        Returns a function applying its changes on the writer thread, or None.
+        :param msg: Incoming message
+        """
 
-        # Add new transaction
+        # Add new transactions
         if msg.packets[0] == 'new_transaction':
+            transactions = []
             for t in msg.packets[1:]:
                 try:
-                    transaction = transaction_fromJSON(t)
-                    if transaction not in self.bc.pending_transactions:
-                        self.bc.add_transaction(transaction)
+                    transaction = loads_transaction(t)
                 except Exception as e:
-                    print(e.with_traceback())
+                    print(f"Invalid transaction: {e!r}")
+                    continue
+                # Seen before, don't verify or relay again
+                if not self.bc.gossip.is_new(transaction.digest):
+                    continue
+                if transaction not in self.bc.pending_transactions and transaction.verify():
+                    transactions.append(transaction)
+            if not transactions:
+                return None
+
+            def apply():
+                # Signatures are cached, add_transaction doesn't verify them again
+                for transaction in transactions:
+                    self.bc.add_transaction(transaction)
+            return apply
 
         # Mined new block
         elif msg.packets[0] == 'mined':
-            new_block = fromJSON(msg.packets[1])
-            if new_block.verify_block():
-                node.bc.chain.append(new_block)
-                for t in node.bc.pending_transactions:
-                    if t in new_block.transactions:
-                        node.bc.pending_transactions.remove(t)
-            else:
+            new_block = loads_block(msg.packets[1])
+            # Signatures are checked in parallel by the batch verifier and cached
+            if not new_block.verify_block():
                 print(bcolors.FAIL + "Invalid block!" + bcolors.ENDC)
+                return None
+
+            def apply():
+                # Extends the chain, keeps a side branch or switches to it, see BlockTree.
+                # Extending cancels mining of the same height.
+                status = self.bc.tree.receive_block(new_block)
+                if status == "invalid":
+                    print(bcolors.FAIL + "Invalid block!" + bcolors.ENDC)
+                elif status == "orphan" and not self.sync.active:
+                    # Kept until its parent arrives. The block ID is only a claim,
+                    # sync starts from the length the peer announces, see set_chain_length.
+                    self.send_to(msg.sender, 'get_chain_length')
+            return apply
+
+        # Light client asking for firmware inclusion proof
+        elif msg.packets[0] == 'get_proof':
+            from_height = msg.packets[2] if len(msg.packets) > 2 else None
+            proof = self.bc.get_proof(msg.packets[1], from_height)
+            if proof is not None:
+                self.send_to(msg.sender, 'proof', msg.packets[1], json.dumps(proof))
+
+        # Inclusion proof requested with get_proof
+        elif msg.packets[0] == 'proof':
+            file_hash = msg.packets[1]
+            if file_hash not in self.proof_requests:
+                return
+            proof = json.loads(msg.packets[2])
+            # Headers have to continue our own chain
+            from_height = proof.get("from_height")
+            if from_height == 0:
+                valid = verify_proof(proof, file_hash, "0" * 64)
+            elif isinstance(from_height, int) and 0 < from_height <= len(self.bc.chain):
+                valid = verify_proof(proof, file_hash, self.bc.block_hash(from_height - 1))
+            else:
+                valid = False
+            if valid:
+                del self.proof_requests[file_hash]
+            self.proofs[file_hash] = (proof, valid)
+            self.proofs.move_to_end(file_hash)
+            while len(self.proofs) > self.MAX_PROOFS:
+                self.proofs.popitem(last=False)
+            print(f"Proof of {file_hash}: {'valid' if valid else 'invalid'}")
 
         # Someone asking for chain length
         elif msg.packets[0] == 'get_chain_length':
-            msg.reply(type=b'whisper', packets=len(
-                self.bc.chain), sender=msg.sender)
+            self.send_to(msg.sender, 'set_chain_length', len(self.bc.chain))
 
         # Someone sending chain length
         elif msg.packets[0] == 'set_chain_length':
-            # todo podmiana od razu czy po czasie?
-            if msg.packets[1] > self.longest_chain:
-                self.longest_chain = msg.packets[1]
-                self.longest_chain_owner == msg.sender
+            def apply():
+                if msg.packets[1] > self.longest_chain:
+                    self.longest_chain = msg.packets[1]
+                    self.longest_chain_owner = msg.sender
+
+                    print(f"{self.longest_chain} {self.longest_chain_owner}")
+                self.sync.start(msg.sender, msg.packets[1])
+            return apply
+
+        # Headers-first sync
+        elif msg.packets[0] == 'get_headers':
+            count = min(msg.packets[2], HeaderSync.HEADER_BATCH)
+            headers = [b.header for b in self.bc.get_blocks(msg.packets[1], count)]
+            self.send_to(msg.sender, 'headers', msg.packets[1], headers)
+
+        elif msg.packets[0] == 'headers':
+            return lambda: self.sync.on_headers(msg.sender, msg.packets[1], msg.packets[2])
 
-                print(f"{self.longest_chain} {self.longest_chain_owner}")
+        elif msg.packets[0] == 'get_bodies':
+            count = min(msg.packets[2], HeaderSync.RANGE_SIZE)
+            bodies = [encode_block(b) for b in self.bc.get_blocks(msg.packets[1], count)]
+            self.send_to(msg.sender, 'bodies', msg.packets[1], bodies)
+
+        elif msg.packets[0] == 'bodies':
+            return lambda: self.sync.on_bodies(msg.sender, msg.packets[1], msg.packets[2])
+
+        # Firmware distribution, see BlobStore
+        elif msg.packets[0] in ('get_manifest', 'get_chunk') and not is_hash(msg.packets[1]):
+            # Hashes name files in the store, ignore anything else
+            print(bcolors.WARNING + f"Invalid {msg.packets[0]} request" + bcolors.ENDC)
+
+        elif msg.packets[0] == 'get_manifest' and self.blobs is not None:
+            manifest = self.blobs.get_manifest(msg.packets[1])
+            self.send_to(msg.sender, 'manifest', msg.packets[1],
+                         encode_manifest(manifest) if manifest is not None else None)
+
+        elif msg.packets[0] == 'manifest' and self.fetcher is not None:
+            self.fetcher.on_manifest(msg.packets[1], msg.packets[2])
+
+        elif msg.packets[0] == 'get_chunk' and self.blobs is not None:
+            self.send_to(msg.sender, 'chunk', msg.packets[1], self.blobs.get_chunk(msg.packets[1]))
+
+        elif msg.packets[0] == 'chunk' and self.fetcher is not None:
+            # Chunk hash is checked before storing
+            self.fetcher.on_chunk(msg.sender, msg.packets[1], msg.packets[2])
+        return None
 
     def on_connect(self, sock: py2p.MeshSocket):
         """
@@ -124,7 +286,7 @@ if __name__ == "__main__":
         port = int(sys.argv[-1])
 
     # Communications setup
-    node = Node(port=port)
+    node = Node(port=port, data_dir=f"chaindata/{port}")
     print(bcolors.OKGREEN + "Node setup done." + bcolors.ENDC)
 
     if port != 6000:
@@ -145,10 +307,19 @@ if __name__ == "__main__":
                 peers
                 connect <ip_address:port>
                 id
+                fingerprint
+                trusted
                 msg <params>
                 stats
                 mine
                 add_test_transaction
+                firmware <path> <version>
+                fetch <manifest_hash> <output_path>
+                format [json|msgpack]
+                formats
+                proof <file_hash>
+                sync
+                trace on|off|dump <file>
                 """+bcolors.ENDC)
 
             elif i == 'exit' or i == 'e' or i == 'quit' or i == 'q':
@@ -176,9 +347,22 @@ if __name__ == "__main__":
             elif i == 'id':
                 print(bcolors.OKBLUE + str(node.sock.id)[2:-1] + bcolors.ENDC)
 
+            elif i == 'fingerprint':
+                print(bcolors.OKBLUE + key_manager.fingerprint(node.bc.public_key) + bcolors.ENDC)
+
+            elif i == 'trusted':
+                if trusted_keys.enabled:
+                    print(bcolors.OKBLUE + f"{len(trusted_keys)} trusted keys" + bcolors.ENDC)
+                else:
+                    print(bcolors.OKBLUE + "All authors trusted, no " + trusted_keys.path + bcolors.ENDC)
+
             elif i == 'stats':
                 print(bcolors.OKBLUE + "Chain: " + str(node.bc.chain))
-                print("Pending: " + str(node.bc.pending_transactions) + bcolors.ENDC)
+                print("Pending: " + str(node.bc.pending_transactions))
+                print("Signature cache: " + str(signature_cache.stats))
+                print("Gossip: " + str(node.bc.gossip.stats))
+                print("Pipeline: " + str(node.pipeline.stats))
+                print("Block tree: " + str(node.bc.tree.stats) + bcolors.ENDC)
 
             elif i.startswith("msg"):
                 m = i.split(" ")
@@ -187,6 +371,36 @@ if __name__ == "__main__":
             elif i == 'mine':
                 node.bc.mine()
 
+            elif i.startswith('format '):
+                fmt = i.split(" ")[1]
+                if fmt in FORMATS:
+                    node.bc.wire_format = fmt
+                else:
+                    print(bcolors.FAIL + "Unknown format." + bcolors.ENDC)
+
+            elif i == 'sync':
+                node.sock.send(type='get_chain_length')
+                print(bcolors.OKBLUE + str(node.sync.stats) + bcolors.ENDC)
+
+            elif i.startswith('trace '):
+                command = i.split(" ")
+                if command[1] == 'on':
+                    tracer.enabled = True
+                elif command[1] == 'off':
+                    tracer.enabled = False
+                elif command[1] == 'dump' and len(command) == 3:
+                    count = tracer.dump(command[2])
+                    print(bcolors.OKBLUE + f"Wrote {count} spans to {command[2]}" + bcolors.ENDC)
+                else:
+                    print(bcolors.FAIL + "Usage: trace on|off|dump <file>" + bcolors.ENDC)
+
+            elif i.startswith('proof '):
+                node.request_proof(i.split(" ")[1])
+
+            elif i == 'formats':
+                for fmt, result in compare_formats(node.bc.chain[-100:]).items():
+                    print(bcolors.OKBLUE + fmt + ": " + str(result) + bcolors.ENDC)
+
             elif i == 'add_test_transaction' or i == 't':
                 transaction = Transaction(
                     node.bc.public_key, "test", "hash", "test.name")
@@ -194,6 +408,33 @@ if __name__ == "__main__":
                 node.bc.add_transaction(transaction)
                 print(bcolors.OKBLUE + "Transaction added" + bcolors.ENDC)
 
+            elif i.startswith('firmware '):
+                try:
+                    _, path, version = i.split(" ")
+                    transaction = node.bc.add_transaction_from_file(path, version, blobs=node.blobs)
+                except ValueError:
+                    print(bcolors.FAIL + "Usage: firmware <path> <version>" + bcolors.ENDC)
+                except OSError as e:
+                    print(bcolors.FAIL + str(e) + bcolors.ENDC)
+                else:
+                    if transaction is None:
+                        print(bcolors.FAIL + "Transaction rejected" + bcolors.ENDC)
+                    else:
+                        print(bcolors.OKBLUE + "Transaction added, hash " + transaction.file_hash + bcolors.ENDC)
+
+            elif i.startswith('fetch '):
+                try:
+                    _, m_hash, path = i.split(" ")
+                except ValueError:
+                    print(bcolors.FAIL + "Usage: fetch <manifest_hash> <output_path>" + bcolors.ENDC)
+                else:
+                    if node.fetcher is None:
+                        print(bcolors.FAIL + "No blob store" + bcolors.ENDC)
+                    elif node.fetcher.fetch(m_hash) and node.blobs.assemble(m_hash, path):
+                        print(bcolors.OKBLUE + "Saved " + path + bcolors.ENDC)
+                    else:
+                        print(bcolors.FAIL + "Download failed" + bcolors.ENDC)
+
             elif i == 'last block' or i == 'lb':
                 print(node.bc.last_block.toJSON())
 
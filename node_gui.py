@@ -1,16 +1,17 @@
 import json
-import random
 import sys
-from datetime import datetime
+import time
 
-import py2p
-from cryptography.hazmat.backends.openssl.rsa import (_RSAPrivateKey,
-                                                      _RSAPublicKey)
-from flask import Flask, render_template, request
+import umsgpack
+from flask import Flask, Response, g, render_template, request
 
 from blockchain import Blockchain
-from data_manipulation import get_chain
+from codec import array_header, block_to_list, encode_block
+from dashboard import SUMMARY_FIELDS, TRANSACTION_FIELDS, ChainSummary, transaction_rows
+from data_manipulation import sync_chain
+import metrics
 from node import Node
+from tracing import tracer
 from transaction import Transaction
 
 app = Flask(__name__, template_folder="interface", static_folder="interface")
@@ -21,60 +22,71 @@ else:
     port = int(sys.argv[-1])
 
 
-node = Node(port=int(port+1000))
-if port != 5000:
-    node.sock.connect('0.0.0.0', 6000)
-b = node.bc
+MAX_BLOCKS_PAGE = 500  # Maximum number of blocks returned by get_blocks
+STREAM_CHUNK = 100  # Blocks read at once under the chain lock while streaming
+
+# Mining workers import this script as __mp_main__, they must not start another node
+if __name__ != "__mp_main__":
+    node = Node(port=int(port+1000), data_dir=f"chaindata/{port+1000}")
+    if port != 5000:
+        node.sock.connect('0.0.0.0', 6000)
+    b = node.bc
+
+    summary = ChainSummary(b)  # Cached rows of the blocks table
+
+@app.before_request
+def start_span():
+    """
+    Remembers when the request started for its trace span
+    """
+    g.trace_start = time.perf_counter()
+
+
+@app.teardown_request
+def record_span(exception=None):
+    """
+    Records span of the request handler, REST calls are named by their action
+    """
+    if tracer.enabled and "trace_start" in g:
+        body = request.get_json(silent=True) if request.is_json else None
+        action = body.get("action") if isinstance(body, dict) else None
+        name = f"{request.method} {request.path}" + (f" {action}" if action else "")
+        tracer.record(name, g.trace_start, time.perf_counter(), status="error" if exception else "ok")
+
 
 @app.route('/', methods=['GET'])
 def index():
     """
-    Returns index page
-    """
-
-    data = [] # Stores data for tables
-    head = b.chain[0].__dict__.keys() # Blockchain table headers
-
-    # Prepare blocks data for table
-    for block in b.chain:
-        line = []
-        for v in block.__dict__.values():
-            if type(v) is datetime:
-                line.append(v.strftime("%d/%m/%Y, %H:%M:%S"))
-            elif type(v) is list:
-                line.append(len(v))
-            else:
-                line.append(v)
-        data.append(line)
-
-    # Prepare pending tansactions data for table
-    if len(b.pending_transactions) > 0:
-        t_h = b.pending_transactions[0].__dict__.keys()
-        p_t = []
-        for t in b.pending_transactions:
-            line = []
-            for v in t.__dict__.values():
-                if type(v) is _RSAPublicKey:
-                    if t.is_signed:
-                        signed = "Signed"
-                    else:
-                        signed = "Not signed"
-                    line.append(signed)
-                elif type(v) is bytes:
-                    line.append(hash(v))
-                else:
-                    line.append(v)
-            p_t.append(line)
-    else: # if there are no pending transactions
-        t_h = []
-        p_t = []
+    Returns index page, optional query parameter: page
+    """
+
+    page = request.args.get("page", 1, type=int)
+    blocks, pages = summary.page(page)
+    pending, _ = transaction_rows(b.pending_transactions, 1)
 
     # Renders the website
     return render_template("index.html",
-                           blocks=data,
-                           head=head,
-                           transactions_head=t_h,
-                           pending_transactions=p_t)
+                           blocks=blocks,
+                           head=SUMMARY_FIELDS,
+                           page=min(max(page, 1), pages),
+                           pages=pages,
+                           transactions_head=TRANSACTION_FIELDS,
+                           pending_transactions=pending,
+                           pending_count=len(b.pending_transactions))
+
+@app.route("/mempool/")
+def mempool():
+    """
+    Returns page of pending transactions, optional query parameter: page
+    """
+    page = request.args.get("page", 1, type=int)
+    pending, pages = transaction_rows(b.pending_transactions, page)
+    return render_template("mempool.html",
+                           transactions_head=TRANSACTION_FIELDS,
+                           pending_transactions=pending,
+                           pending_count=len(b.pending_transactions),
+                           page=min(max(page, 1), pages),
+                           pages=pages)
 
 @app.route("/network/")
 def network():
@@ -82,30 +94,119 @@ def network():
 
 @app.route("/raw/")
 def raw():
-    data = []
-    head = b.chain[0].__dict__.keys()
-    for block in b.chain:
-        line = []
-        for v in block.__dict__.values():
-            line.append(v)
-        data.append(line)
-
-    if len(b.pending_transactions) > 0:
-        t_h = b.pending_transactions[0].__dict__.keys()
-        p_t = []
-        for t in b.pending_transactions:
-            line = []
-            for v in t.__dict__.values():
-                line.append(v)
-            p_t.append(line)
+    """
+    Returns a page of the chain summary and pending transactions as JSON,
+    optional query parameters: page, mempool_page
+    """
+    blocks, pages = summary.page(request.args.get("page", 1, type=int))
+    pending, pending_pages = transaction_rows(b.pending_transactions,
+                                              request.args.get("mempool_page", 1, type=int))
+    return json.dumps({"blocks": blocks,
+                       "head": SUMMARY_FIELDS,
+                       "pages": pages,
+                       "transactions_head": TRANSACTION_FIELDS,
+                       "pending_transactions": pending,
+                       "pending_pages": pending_pages})
+
+@app.route("/events")
+def events():
+    """
+    Server-sent events with rows of new blocks, see ChainSummary.events
+    """
+    return Response(summary.events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
+
+
+def chain_range(start, end):
+    """
+    Returns validated [start, end) block range, whole chain by default
+    :param start: First block ID or None
+    :param end: Block ID after the last one or None
+    """
+    length = len(b.chain)
+    start = 0 if start is None else min(max(int(start), 0), length)
+    end = length if end is None else min(max(int(end), start), length)
+    return start, end
+
+
+def read_chunks(start, end, tip_hash):
+    """
+    Yields lists of at most STREAM_CHUNK blocks from [start, end), each read under the chain lock.
+    Yields None and stops if block end - 1 no longer has tip_hash, the chain was reorganized.
+    :param start: First block ID
+    :param end: Block ID after the last one
+    :param tip_hash: Hash of block end - 1 when the stream started
+    """
+    for chunk_start in range(start, end, STREAM_CHUNK):
+        with b.lock:
+            if len(b.chain) < end or b.block_hash(end - 1) != tip_hash:
+                yield None
+                return
+            chunk = b.chain[chunk_start:min(chunk_start + STREAM_CHUNK, end)]
+        yield chunk
+
+
+def stream_chain(start, end, fmt="json"):
+    """
+    Returns streamed response with blocks [start, end).
+    Uses cached block encodings and answers 304 if the client has the same tip and range.
+    If the chain is reorganized while streaming, the response is cut short so
+    it does not mix blocks of two branches under one ETag.
+    :param start: First block ID or None
+    :param end: Block ID after the last one or None
+    :param fmt: "json" or "msgpack"
+    """
+    with b.lock:
+        start, end = chain_range(start, end)
+        tip_hash = b.block_hash(end - 1) if end > 0 else ''
+    etag = f"{tip_hash}-{start}-{end}-{fmt}"
+    if etag in request.if_none_match:
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+
+    chunks = read_chunks(start, end, tip_hash)
+    if fmt == "msgpack":
+        def generate():
+            yield array_header(end - start)
+            for chunk in chunks:
+                if chunk is None:
+                    return
+                for block in chunk:
+                    yield encode_block(block)
+        mimetype = "application/msgpack"
     else:
-        t_h = []
-        p_t = []
+        # Same output as Blockchain.toJSON
+        def generate():
+            yield "["
+            first = True
+            for chunk in chunks:
+                if chunk is None:
+                    return
+                for block in chunk:
+                    yield ("" if first else ", ") + json.dumps(block.toJSON())
+                    first = False
+            yield "]"
+        mimetype = "application/json"
 
-    return json.dumps({"blocks": str(data),
-                       "head": str(head),
-                       "transactions_head": t_h,
-                       "pending_transactions": p_t})
+    return Response(generate(), mimetype=mimetype, headers={"ETag": f'"{etag}"'})
+
+
+@app.route('/rest/chain', methods=['GET'])
+def get_chain_stream():
+    """
+    Streams chain, optional query parameters: start, end, format
+    """
+    return stream_chain(request.args.get("start"), request.args.get("end"),
+                        request.args.get("format", "json"))
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Returns node metrics in the Prometheus text format, enabled with FIRMWARECHAIN_METRICS=1
+    """
+    if not metrics.registry.enabled:
+        return "Metrics disabled", 404
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route('/rest/', methods=['POST'])
@@ -119,8 +220,31 @@ def rest_api():
         req = request.json
         print(request.remote_addr, request.environ['REMOTE_PORT'])
         if action == "get_chain":
-            return b.toJSON()
+            return stream_chain(req.get("start"), req.get("end"), req.get("format", "json"))
         
+        elif action == "get_blocks":
+            from_height = int(req["from_height"])
+            from_hash = req.get("from_hash")
+            limit = min(int(req.get("limit", MAX_BLOCKS_PAGE)), MAX_BLOCKS_PAGE)
+            # from_hash is the hash of block from_height - 1, genesis has no parent
+            if from_hash is not None and from_height <= 0:
+                return "from_height must be at least 1 with from_hash", 400
+            fork = (from_hash is not None
+                    and (from_height > len(b.chain) or b.block_hash(from_height - 1) != from_hash))
+            blocks = [] if fork else b.get_blocks(from_height, limit)
+            page = {"height": len(b.chain) - 1, "fork": fork}
+            if req.get("format") == "msgpack":
+                page["blocks"] = [block_to_list(block) for block in blocks]
+                return Response(umsgpack.packb(page), mimetype="application/msgpack")
+            page["blocks"] = [block.toJSON() for block in blocks]
+            return json.dumps(page)
+
+        elif action == "get_proof":
+            proof = b.get_proof(req["file_hash"], req.get("from_height"))
+            if proof is None:
+                return "Unknown file hash", 404
+            return json.dumps(proof)
+
         elif action == "get_peers":
             return json.dumps(node.sock.routing_table)
 
@@ -133,6 +257,17 @@ def rest_api():
             print("Added transaction")
             return "reload"
 
+        elif action == "add_firmware":
+            try:
+                t = b.add_transaction_from_file(req["path"], req["version"], req.get("filename"),
+                                                node.blobs)
+            except OSError as e:
+                return str(e), 404
+            if t is None:
+                return "Transaction rejected", 409
+            return json.dumps({"file_hash": t.file_hash, "filename": t.filename,
+                               "manifest": t.manifest})
+
         elif action == "mine":
             b.mine()
             return "reload"
@@ -142,8 +277,8 @@ def rest_api():
         
         elif action == "set_chain":
             ip = req["ip"]
-            chain = get_chain(ip)
-            b.chain = chain
+            appended = sync_chain(ip, b, fmt=req.get("format", "json"))
+            return str(appended)
 
         else:
             print(action)
@@ -0,0 +1,158 @@
+import heapq
+import itertools
+import queue
+import threading
+from collections import Counter
+from typing import Any, Callable, Dict, Optional
+
+import metrics
+from tracing import tracer
+
+# Lower is more important: blocks first, sync traffic next, requests, then transactions
+PRIORITIES = {
+    'mined': 0,
+    'headers': 1,
+    'bodies': 1,
+    'set_chain_length': 1,
+    'manifest': 1,
+    'chunk': 1,
+    'proof': 2,
+    'get_chain_length': 2,
+    'get_headers': 2,
+    'get_bodies': 2,
+    'get_proof': 2,
+    'get_manifest': 2,
+    'get_chunk': 2,
+    'new_transaction': 3,
+}
+DEFAULT_PRIORITY = 2
+
+
+class Pipeline:
+    """
+    Processes incoming messages off the network thread.
+    Messages wait in a bounded priority queue, a pool of workers runs the prepare stage
+    (parsing, signature verification) concurrently and a single writer thread applies
+    the resulting chain and mempool changes in order.
+    When the queue is full the least important message is dropped.
+    """
+    MAX_QUEUE = 1000  # Messages waiting for a worker
+    MAX_WRITES = 100  # Prepared changes waiting for the writer, workers block when full
+
+    def __init__(self, prepare: Callable[[Any], Optional[Callable[[], None]]],
+                 workers: int = 4, lock: threading.RLock = None):
+        """
+        Pipeline class constructor
+        :param prepare: Function processing a message, returning a function applying
+            its changes or None if there is nothing to apply
+        :param workers: Number of prepare threads
+        :param lock: Lock held by the writer while applying changes
+        """
+
+        self.prepare = prepare
+        self.lock = lock or threading.RLock()
+        self.received = Counter()  # Message type -> number of messages
+        self.dropped = Counter()  # Message type -> number of dropped messages
+        self.failed = 0  # Messages whose processing raised an exception
+        self.max_depth = 0
+        self._heap = []  # (priority, sequence, message type, message)
+        self._sequence = itertools.count()
+        self._not_empty = threading.Condition()
+        self._writes = queue.Queue(self.MAX_WRITES)
+        self._closed = False
+
+        self._threads = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(workers)]
+        self._threads.append(threading.Thread(target=self._write, daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, msg_type: str, message) -> bool:
+        """
+        Queues message without blocking.
+        Returns False if it was dropped because the queue is full.
+        :param msg_type: Message type, decides the priority
+        :param message: Message passed to the prepare function
+        """
+        priority = PRIORITIES.get(msg_type, DEFAULT_PRIORITY)
+        with self._not_empty:
+            if self._closed:
+                return False
+            self.received[msg_type] += 1
+            metrics.messages.inc(type=msg_type)
+            if len(self._heap) >= self.MAX_QUEUE:
+                # Evict the newest message of the lowest priority, unless it is this one
+                worst = max(self._heap)
+                if worst[0] <= priority:
+                    self.dropped[msg_type] += 1
+                    return False
+                self._heap.remove(worst)
+                heapq.heapify(self._heap)
+                self.dropped[worst[2]] += 1
+
+            heapq.heappush(self._heap, (priority, next(self._sequence), msg_type, message))
+            self.max_depth = max(self.max_depth, len(self._heap))
+            self._not_empty.notify()
+        return True
+
+    def _work(self):
+        while True:
+            with self._not_empty:
+                while not self._heap and not self._closed:
+                    self._not_empty.wait()
+                if self._closed:
+                    return
+                _, _, msg_type, message = heapq.heappop(self._heap)
+            try:
+                with metrics.message_seconds.time(type=msg_type, stage="prepare"), \
+                        tracer.span("prepare " + msg_type):
+                    apply = self.prepare(message)
+            except Exception as e:
+                self.failed += 1
+                print(f"Failed to process {msg_type}: {e!r}")
+                continue
+            if apply is not None:
+                self._writes.put((msg_type, apply))
+
+    def _write(self):
+        while True:
+            item = self._writes.get()
+            if item is None:
+                return
+            msg_type, apply = item
+            try:
+                with self.lock, metrics.message_seconds.time(type=msg_type, stage="apply"), \
+                        tracer.span("apply " + msg_type):
+                    apply()
+            except Exception as e:
+                self.failed += 1
+                print(f"Failed to apply {msg_type}: {e!r}")
+
+    @property
+    def depth(self) -> int:
+        """
+        Returns number of messages waiting for a worker
+        """
+        return len(self._heap)
+
+    @property
+    def stats(self) -> Dict:
+        """
+        Returns queue depths and message counters
+        """
+        return {"depth": self.depth,
+                "max_depth": self.max_depth,
+                "writes": self._writes.qsize(),
+                "received": dict(self.received),
+                "dropped": dict(self.dropped),
+                "failed": self.failed}
+
+    def close(self):
+        """
+        Stops workers, queued messages are discarded
+        """
+        with self._not_empty:
+            self._closed = True
+            self._heap = []
+            self._not_empty.notify_all()
+        self._writes.put(None)
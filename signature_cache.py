@@ -0,0 +1,71 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+
+class SignatureCache:
+    """
+    Bounded LRU cache of transaction verification results keyed by transaction digest
+    """
+
+    def __init__(self, maxsize: int = 100000):
+        """
+        SignatureCache class constructor
+        :param maxsize: Maximum number of stored results
+        """
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, digest: str) -> Optional[bool]:
+        """
+        Returns cached verification result or None if transaction wasn't verified yet
+        :param digest: Transaction digest
+        """
+        with self._lock:
+            result = self._results.get(digest)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._results.move_to_end(digest)
+            return result
+
+    def put(self, digest: str, result: bool):
+        """
+        Stores verification result, evicting the least recently used one if full
+        :param digest: Transaction digest
+        :param result: Verification result
+        """
+        with self._lock:
+            self._results[digest] = result
+            self._results.move_to_end(digest)
+            if len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all results and resets counters
+        """
+        with self._lock:
+            self._results.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @property
+    def stats(self) -> dict:
+        """
+        Returns cache counters
+        """
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._results), "maxsize": self.maxsize}
+
+    def __len__(self):
+        return len(self._results)
+
+
+# Cache shared by all transactions of the node
+signature_cache = SignatureCache()
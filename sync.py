@@ -0,0 +1,373 @@
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+from block import DIFFICULTY, header_hash, unpack_header
+from codec import decode_block
+import metrics
+
+
+class PeerStats:
+    """
+    Download statistics of a single peer
+    """
+
+    def __init__(self):
+        self.blocks = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.failures = 0  # Timeouts and invalid responses, lowered by valid ones
+        self.failed_at = 0.0  # time.monotonic() of the last failure
+        self.in_flight = 0  # Body requests waiting for a response
+
+    def fail(self):
+        """
+        Records a timeout or an invalid response
+        """
+        self.failures += 1
+        self.failed_at = time.monotonic()
+
+    def succeed(self):
+        """
+        Records a valid response, one success forgives one failure
+        """
+        self.failures = max(0, self.failures - 1)
+
+    @property
+    def throughput(self) -> float:
+        """
+        Returns downloaded blocks per second, lowered by failures.
+        Peers without history are tried first.
+        """
+        if self.seconds == 0:
+            return float("inf")
+        return self.blocks / self.seconds / (1 + self.failures)
+
+    def __repr__(self):
+        return (f"PeerStats(blocks={self.blocks}, bytes={self.bytes}, "
+                f"seconds={self.seconds:.2f}, failures={self.failures})")
+
+
+class HeaderSync:
+    """
+    Headers-first chain sync.
+    Headers are downloaded from one peer and validated first, then block bodies
+    are requested in ranges from all peers at once, faster peers getting more work.
+    Ranges not delivered in time are reassigned to another peer.
+    If the peer's chain forked from ours, the common ancestor is searched for first,
+    going back in growing steps, and our blocks after it are replaced once the
+    downloaded branch is longer.
+    """
+    HEADER_BATCH = 2000  # Headers per get_headers request
+    RANGE_SIZE = 50  # Bodies per get_bodies request
+    MAX_IN_FLIGHT = 2  # Body requests per peer at once
+    TIMEOUT = 10.0  # Seconds to wait for a response
+    MAX_FAILURES = 3  # Peers failing more often are not used for a while
+    RETRY_AFTER = 60.0  # Seconds after the last failure when such peers are tried again
+
+    def __init__(self, blockchain, send: Callable, peers: Callable[[], List[bytes]]):
+        """
+        HeaderSync class constructor
+        :param blockchain: Blockchain object to extend
+        :param send: Function sending a message to a peer: send(peer_id, msg_type, *packets)
+        :param peers: Function returning IDs of connected peers
+        """
+
+        self.blockchain = blockchain
+        self.send = send
+        self.peers = peers
+        self.stats = {}  # type: Dict[bytes, PeerStats]
+        self._lock = threading.RLock()
+        self._watchdog_thread = None
+        self._reset()
+
+    def _reset(self):
+        for stats in self.stats.values():
+            stats.in_flight = 0
+        self.active = False
+        self.header_peer = None
+        self.start_height = 0  # ID of the first block being synced
+        self.header_hashes = []  # Hashes of validated headers from start_height
+        self.ancestor_found = False  # A header followed one of our blocks
+        self.fork = False  # Local blocks from start_height have to be replaced
+        self._step = 1  # Blocks to go back when looking for the common ancestor
+        self.headers_done = False
+        self.queue = []  # type: List[Tuple[int, int]]  # (first block, count) waiting for a peer
+        self.in_flight = {}  # type: Dict[int, Tuple[int, bytes, float]]  # first block -> (count, peer, sent at)
+        self.bodies = {}  # Block ID -> (block, peer)
+        self._tip_hash = None
+        self._headers_sent = 0.0
+
+    def _stats(self, peer: bytes) -> PeerStats:
+        if peer not in self.stats:
+            self.stats[peer] = PeerStats()
+        return self.stats[peer]
+
+    def _usable(self, peer: bytes) -> bool:
+        """
+        Returns False for peers which failed too often recently
+        """
+        stats = self._stats(peer)
+        return (stats.failures < self.MAX_FAILURES
+                or time.monotonic() - stats.failed_at > self.RETRY_AFTER)
+
+    def start(self, peer: bytes, remote_length: int) -> bool:
+        """
+        Starts syncing if peer has a longer chain.
+        Returns False if sync is already running or not needed.
+        :param peer: ID of the peer which announced its chain length
+        :param remote_length: Number of blocks in peer's chain
+        """
+        with self._lock:
+            if self.active or remote_length <= len(self.blockchain.chain):
+                return False
+            self._reset()
+            self.active = True
+            self.header_peer = peer
+            self.start_height = len(self.blockchain.chain)
+            self._tip_hash = self.blockchain.last_hash
+            self._request_headers()
+
+            if self._watchdog_thread is None or not self._watchdog_thread.is_alive():
+                self._watchdog_thread = threading.Thread(target=self._watchdog, daemon=True)
+                self._watchdog_thread.start()
+        return True
+
+    def _request_headers(self):
+        self._headers_sent = time.monotonic()
+        self.send(self.header_peer, 'get_headers',
+                  self.start_height + len(self.header_hashes), self.HEADER_BATCH)
+
+    def on_headers(self, peer: bytes, from_height: int, headers: List[bytes]):
+        """
+        Validates received headers and queues download of their bodies
+        :param peer: ID of the sender
+        :param from_height: ID of the first header's block
+        :param headers: Block headers
+        """
+        with self._lock:
+            if (not self.active or peer != self.header_peer
+                    or from_height != self.start_height + len(self.header_hashes)):
+                return
+
+            before = len(self.header_hashes)
+            for raw in headers:
+                fields = unpack_header(raw)
+                block_hash = header_hash(raw)
+                if (fields["block_id"] != self.start_height + len(self.header_hashes)
+                        or not block_hash.startswith('0' * DIFFICULTY)):
+                    self._stats(peer).fail()
+                    self._reset()
+                    return
+                if fields["prev_hash"] != self._tip_hash:
+                    if self.ancestor_found:
+                        self._stats(peer).fail()
+                        self._reset()
+                    else:
+                        # Peer's chain forked from ours, not a failure
+                        self._step_back()
+                    return
+                self.ancestor_found = True
+                if not self.header_hashes and block_hash == self._local_hash(fields["block_id"]):
+                    # Block we already have, the fork is further
+                    self.start_height += 1
+                    self._tip_hash = block_hash
+                    continue
+                if not self.header_hashes:
+                    self.fork = self.start_height < len(self.blockchain.chain)
+                self.header_hashes.append(block_hash)
+                self._tip_hash = block_hash
+
+            self._stats(peer).succeed()
+            first = self.start_height + before
+            last = self.start_height + len(self.header_hashes)
+            for start in range(first, last, self.RANGE_SIZE):
+                self.queue.append((start, min(self.RANGE_SIZE, last - start)))
+
+            if len(headers) < self.HEADER_BATCH:
+                self.headers_done = True
+                if (self.fork or not self.header_hashes) and last <= len(self.blockchain.chain):
+                    # Peer's branch isn't longer, ours stays
+                    self._reset()
+                    return
+            else:
+                self._request_headers()
+            self._schedule()
+            self._check_done()
+
+    def _local_hash(self, height: int) -> str:
+        """
+        Returns hash of our block at given height, None above the tip
+        """
+        if height >= len(self.blockchain.chain):
+            return None
+        return self.blockchain.block_hash(height)
+
+    def _step_back(self):
+        """
+        Requests headers from further back, doubling the distance each time, like sync_chain
+        """
+        if self.start_height <= 1:
+            print("Sync stopped, different genesis block")
+            self._reset()
+            return
+        self.start_height = max(1, self.start_height - self._step)
+        self._step *= 2
+        self._tip_hash = self.blockchain.block_hash(self.start_height - 1)
+        self._request_headers()
+
+    def _schedule(self):
+        """
+        Hands queued ranges to the fastest peers with free capacity
+        """
+        peers = [p for p in self.peers() if self._usable(p)]
+        peers.sort(key=lambda p: self._stats(p).throughput, reverse=True)
+        for peer in peers:
+            while self.queue and self._stats(peer).in_flight < self.MAX_IN_FLIGHT:
+                start, count = self.queue.pop(0)
+                self._request_bodies(peer, start, count)
+
+    def _request_bodies(self, peer: bytes, start: int, count: int):
+        self.in_flight[start] = (count, peer, time.monotonic())
+        self._stats(peer).in_flight += 1
+        self.send(peer, 'get_bodies', start, count)
+
+    def on_bodies(self, peer: bytes, from_height: int, encoded: List[bytes]):
+        """
+        Checks received bodies against their headers and appends what is contiguous
+        :param peer: ID of the sender
+        :param from_height: ID of the first block
+        :param encoded: msgpack encoded blocks
+        """
+        with self._lock:
+            request = self.in_flight.get(from_height)
+            if not self.active or request is None or request[1] != peer:
+                return  # Late response of a reassigned range
+            count, _, sent = request
+            del self.in_flight[from_height]
+            stats = self._stats(peer)
+            stats.in_flight -= 1
+
+            try:
+                blocks = [decode_block(data) for data in encoded]
+            except Exception:
+                blocks = []
+            valid = len(blocks) == count and all(
+                block.compute_hash() == self.header_hashes[from_height + i - self.start_height]
+                and block.verify_merkle_root()
+                for i, block in enumerate(blocks))
+            if not valid:
+                stats.fail()
+                self.queue.insert(0, (from_height, count))
+                self._schedule()
+                return
+
+            size = sum(len(data) for data in encoded)
+            stats.succeed()
+            stats.blocks += count
+            stats.bytes += size
+            stats.seconds += time.monotonic() - sent
+            label = peer.decode(errors="replace") if isinstance(peer, bytes) else str(peer)
+            metrics.sync_blocks.inc(count, peer=label)
+            metrics.sync_bytes.inc(size, peer=label)
+            metrics.sync_seconds.inc(time.monotonic() - sent, peer=label)
+            for i, block in enumerate(blocks):
+                self.bodies[from_height + i] = (block, peer)
+
+            self._apply()
+            self._schedule()
+            self._check_done()
+
+    def _apply(self):
+        """
+        Appends downloaded bodies following the chain tip
+        """
+        if not self.active:
+            return
+        if self.fork:
+            self._apply_fork()
+            return
+        height = len(self.blockchain.chain)
+        expected = self.header_hashes[height - self.start_height - 1] \
+            if height > self.start_height else None
+        if height < self.start_height or (expected is not None and self.blockchain.last_hash != expected):
+            # Chain changed while syncing
+            self._reset()
+            return
+
+        batch = []
+        while height + len(batch) in self.bodies:
+            batch.append(self.bodies.pop(height + len(batch)))
+        if batch and not self.blockchain.extend_chain([block for block, _ in batch]):
+            for _, peer in batch:
+                self._stats(peer).fail()
+            self._reset()
+
+    def _apply_fork(self):
+        """
+        Switches to the downloaded branch once it is longer than our chain
+        """
+        first = self.bodies.get(self.start_height)
+        if first is None:
+            return
+        if self._local_hash(self.start_height - 1) != first[0].prev_hash:
+            # Chain changed while syncing
+            self._reset()
+            return
+
+        count = 0
+        while self.start_height + count in self.bodies:
+            count += 1
+        if self.start_height + count <= len(self.blockchain.chain):
+            return  # Not more work than our branch yet
+
+        batch = [self.bodies.pop(self.start_height + i) for i in range(count)]
+        if not self.blockchain.tree.switch([block for block, _ in batch]):
+            for _, peer in batch:
+                self._stats(peer).fail()
+            self._reset()
+            return
+        self.fork = False
+        self._apply()
+
+    def _check_done(self):
+        if self.active and self.headers_done and not (self.queue or self.in_flight or self.bodies):
+            print(f"Synced to block {len(self.blockchain.chain) - 1}")
+            self._reset()
+
+    def check_timeouts(self):
+        """
+        Reassigns requests which were not answered in time
+        """
+        with self._lock:
+            if not self.active:
+                return
+            now = time.monotonic()
+
+            if not self.headers_done and now - self._headers_sent > self.TIMEOUT:
+                self._stats(self.header_peer).fail()
+                peers = [p for p in self.peers() if self._usable(p)]
+                if not peers:
+                    self._reset()
+                    return
+                self.header_peer = max(peers, key=lambda p: self._stats(p).throughput)
+                self._request_headers()
+
+            for start, (count, peer, sent) in list(self.in_flight.items()):
+                if now - sent > self.TIMEOUT:
+                    del self.in_flight[start]
+                    stats = self._stats(peer)
+                    stats.in_flight -= 1
+                    stats.fail()
+                    self.queue.insert(0, (start, count))
+            self._schedule()
+
+            if self.queue and not self.in_flight and not any(
+                    self._usable(p) for p in self.peers()):
+                print("Sync stopped, no usable peers")
+                self._reset()
+
+    def _watchdog(self):
+        while self.active:
+            time.sleep(1)
+            self.check_timeouts()
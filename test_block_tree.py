@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from block import Block
+from blockchain import Blockchain
+from keys import KeyManager
+from transaction import Transaction
+
+KEY = KeyManager.generate_private_key()
+
+
+def setUpModule():
+    # Blockchain creates node keys in the working directory
+    global _cwd, _tmp
+    _cwd, _tmp = os.getcwd(), tempfile.mkdtemp()
+    os.chdir(_tmp)
+
+
+def tearDownModule():
+    os.chdir(_cwd)
+    shutil.rmtree(_tmp)
+
+
+def make_branch(blockchain: Blockchain, parent: Block, tags) -> list:
+    """
+    Returns mined blocks following parent, one signed transaction per tag
+    """
+    blocks = []
+    prev_hash, height = parent.compute_hash(), parent.block_id + 1
+    for tag in tags:
+        transaction = Transaction(KEY.public_key(), "1.0", tag, "firmware.bin")
+        transaction.sign(KEY)
+        block = Block(height, [transaction], datetime(2020, 1, 1) + timedelta(seconds=height),
+                      prev_hash)
+        blockchain.proof_of_work(block)
+        blocks.append(block)
+        prev_hash, height = block.compute_hash(), height + 1
+    return blocks
+
+
+def file_hashes(blockchain: Blockchain) -> set:
+    return {t.file_hash for t in blockchain.pending_transactions}
+
+
+class BlockTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.prefix = make_branch(self.blockchain, self.blockchain.last_block, ["c0", "c1"])
+        self.assertTrue(self.blockchain.extend_chain(self.prefix))
+        self.tree = self.blockchain.tree
+
+    def tearDown(self):
+        self.blockchain.close()
+
+    def hashes(self) -> list:
+        return [self.blockchain.block_hash(i) for i in range(len(self.blockchain.chain))]
+
+    def test_orphan_connects_later(self):
+        b1, b2 = make_branch(self.blockchain, self.prefix[-1], ["b1", "b2"])
+        self.assertEqual(self.tree.receive_block(b2), "orphan")
+        self.assertEqual(self.tree.stats["orphans"], 1)
+
+        self.assertEqual(self.tree.receive_block(b1), "connected")
+        self.assertEqual(self.blockchain.last_hash, b2.compute_hash())
+        self.assertEqual(self.tree.stats["orphans"], 0)
+
+    def test_reorg_returns_transactions_to_mempool(self):
+        a1, = make_branch(self.blockchain, self.prefix[-1], ["a1"])
+        self.assertTrue(self.blockchain.extend_chain([a1]))
+        b1, b2 = make_branch(self.blockchain, self.prefix[-1], ["b1", "b2"])
+
+        self.assertEqual(self.tree.receive_block(b1), "side")
+        self.assertEqual(self.tree.receive_block(b2), "reorg")
+        self.assertEqual(self.blockchain.last_hash, b2.compute_hash())
+        self.assertEqual(file_hashes(self.blockchain), {"a1"})
+        self.assertIn(a1.compute_hash(), self.tree.side)
+        self.assertTrue(self.blockchain.verify_chain())
+
+    def test_invalid_branch_restores_old_blocks(self):
+        active = make_branch(self.blockchain, self.prefix[-1], ["a1", "a2"])
+        self.assertTrue(self.blockchain.extend_chain(active))
+        before = self.hashes()
+
+        branch = make_branch(self.blockchain, self.prefix[-1], ["b1", "b2", "b3"])
+        branch[2].prev_hash = "f" * 64
+        self.blockchain.proof_of_work(branch[2])
+
+        self.assertFalse(self.tree.switch(branch))
+        self.assertEqual(self.hashes(), before)
+        self.assertEqual(file_hashes(self.blockchain), set())
+        self.assertEqual(self.tree.reorgs, 0)
+        self.assertTrue(self.blockchain.verify_chain())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from block import Block
+from blockchain import Blockchain
+from chain_store import INDEX_ENTRY, ChainStore, StoredChain
+
+
+def make_blocks(count: int):
+    blocks = []
+    prev_hash = "0" * 64
+    for i in range(count):
+        block = Block(i, [], datetime(2020, 1, 1) + timedelta(seconds=i), prev_hash)
+        blocks.append(block)
+        prev_hash = block.compute_hash()
+    return blocks
+
+
+class ChainStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.blocks = make_blocks(10)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def fill(self, **kwargs) -> ChainStore:
+        store = ChainStore(self.path, **kwargs)
+        for block in self.blocks:
+            store.append(block)
+        return store
+
+    def test_reopen_from_index(self):
+        self.fill(segment_size=1000).close()
+        store = ChainStore(self.path)
+        self.assertEqual(len(store), len(self.blocks))
+        for i, block in enumerate(self.blocks):
+            self.assertEqual(store.block_hash(i), block.compute_hash())
+            self.assertEqual(store.get(i).compute_hash(), block.compute_hash())
+        self.assertEqual(store.hash_index[self.blocks[-1].compute_hash()], len(self.blocks) - 1)
+        store.close()
+
+    def test_torn_tail_is_truncated(self):
+        self.fill().close()
+        segment = os.path.join(self.path, "blocks-00000.log")
+        size = os.path.getsize(segment)
+        # Half written record after the last block
+        with open(segment, "ab") as f:
+            f.write(b"\x00\x00\x01\x00partial")
+
+        store = ChainStore(self.path)
+        self.assertEqual(len(store), len(self.blocks))
+        self.assertEqual(os.path.getsize(segment), size)
+        store.append(make_blocks(11)[-1])
+        store.close()
+        self.assertEqual(len(ChainStore(self.path)), len(self.blocks) + 1)
+
+    def test_unindexed_records_are_recovered(self):
+        self.fill().close()
+        index = os.path.join(self.path, "index.dat")
+        # Crash after writing blocks but before writing their index entries
+        os.truncate(index, 7 * INDEX_ENTRY.size + 5)
+
+        store = ChainStore(self.path)
+        self.assertEqual(len(store), len(self.blocks))
+        self.assertEqual(store.block_hash(9), self.blocks[9].compute_hash())
+        self.assertEqual(os.path.getsize(index), len(self.blocks) * INDEX_ENTRY.size)
+        store.close()
+
+    def test_cache_is_bounded_when_appending(self):
+        chain = StoredChain(ChainStore(self.path))
+        chain.CACHE_SIZE = 4
+        for block in self.blocks:
+            chain.append(block)
+        self.assertEqual(len(chain._cache), 4)
+        self.assertEqual(chain[0].compute_hash(), self.blocks[0].compute_hash())
+        self.assertEqual(len(chain._cache), 4)
+        chain.store.close()
+
+
+class StoredBlockchainTest(unittest.TestCase):
+
+    def setUp(self):
+        # Blockchain creates node keys in the working directory
+        self.cwd = os.getcwd()
+        self.path = tempfile.mkdtemp()
+        os.chdir(self.path)
+        self.blockchain = Blockchain(store=ChainStore(os.path.join(self.path, "chain")))
+        for block in make_blocks(8)[1:]:
+            block.prev_hash = self.blockchain.last_hash
+            self.blockchain.proof_of_work(block)
+            self.blockchain.append_block(block)
+        self.validated = []
+        self.blockchain.validate_blocks = self.count_validation(self.blockchain)
+
+    def tearDown(self):
+        self.blockchain.close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.path)
+
+    def count_validation(self, blockchain):
+        validate = blockchain.validate_blocks
+
+        def counted(blocks, prev_hash, height):
+            self.validated.append(len(blocks))
+            return validate(blocks, prev_hash, height)
+        return counted
+
+    def test_verify_in_windows(self):
+        self.blockchain.VERIFY_WINDOW = 3
+        self.assertTrue(self.blockchain.verify_chain())
+        self.assertEqual(self.validated, [3, 3, 1])
+        self.assertEqual(self.blockchain.verified_height, 7)
+
+    def test_checkpoint_survives_restart(self):
+        self.assertTrue(self.blockchain.verify_chain())
+        self.blockchain.close()
+
+        self.blockchain = Blockchain(store=ChainStore(os.path.join(self.path, "chain")))
+        self.assertEqual(self.blockchain.verified_height, 7)
+        self.validated = []
+        self.blockchain.validate_blocks = self.count_validation(self.blockchain)
+        self.assertTrue(self.blockchain.verify_chain())
+        self.assertEqual(self.validated, [])
+
+    def test_checkpoint_of_removed_block_is_ignored(self):
+        self.assertTrue(self.blockchain.verify_chain())
+        self.blockchain.close()
+        # Blocks lost after the checkpoint was saved
+        store = ChainStore(os.path.join(self.path, "chain"))
+        store.truncate(5)
+        store.on_sync = None
+        store.close()
+
+        self.blockchain = Blockchain(store=ChainStore(os.path.join(self.path, "chain")))
+        self.assertEqual(self.blockchain.verified_height, 0)
+        self.assertTrue(self.blockchain.verify_chain())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from block import Block
+from blockchain import Blockchain
+from codec import encode_block
+from keys import KeyManager
+from sync import HeaderSync
+from transaction import Transaction
+
+KEY = KeyManager.generate_private_key()
+
+
+def setUpModule():
+    # Blockchain creates node keys in the working directory
+    global _cwd, _tmp
+    _cwd, _tmp = os.getcwd(), tempfile.mkdtemp()
+    os.chdir(_tmp)
+
+
+def tearDownModule():
+    os.chdir(_cwd)
+    shutil.rmtree(_tmp)
+
+
+def grow(blockchain: Blockchain, count: int, tag: str):
+    """
+    Appends count blocks with one signed transaction each
+    """
+    for i in range(count):
+        transaction = Transaction(KEY.public_key(), "1.0", f"{tag}-{i}", "firmware.bin")
+        transaction.sign(KEY)
+        height = len(blockchain.chain)
+        block = Block(height, [transaction], datetime(2020, 1, 1) + timedelta(seconds=height),
+                      blockchain.last_hash)
+        blockchain.proof_of_work(block)
+        assert blockchain.extend_chain([block])
+
+
+class Network:
+    """
+    Delivers HeaderSync requests to remote chains, one per peer
+    """
+
+    def __init__(self, remotes: dict):
+        self.remotes = remotes
+        self.outbox = []
+        self.silent = set()  # Peers dropping requests
+        self.sync = None
+
+    def send(self, peer, msg_type, start, count):
+        self.outbox.append((peer, msg_type, start, count))
+
+    def deliver(self):
+        while self.outbox:
+            peer, msg_type, start, count = self.outbox.pop(0)
+            if peer in self.silent:
+                continue
+            blocks = self.remotes[peer].get_blocks(start, count)
+            if msg_type == "get_headers":
+                self.sync.on_headers(peer, start, [block.header for block in blocks])
+            else:
+                self.sync.on_bodies(peer, start, [encode_block(block) for block in blocks])
+
+    def requested(self, peer) -> int:
+        return sum(1 for m in self.outbox if m[0] == peer and m[1] == "get_bodies")
+
+
+class HeaderSyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.remote = Blockchain()
+        grow(self.remote, 12, "remote")
+        self.local = Blockchain()
+
+    def tearDown(self):
+        self.remote.close()
+        self.local.close()
+
+    def make_sync(self, peers) -> (HeaderSync, Network):
+        network = Network({peer: self.remote for peer in peers})
+        sync = HeaderSync(self.local, network.send, lambda: list(peers))
+        sync.RANGE_SIZE = 4
+        network.sync = sync
+        return sync, network
+
+    def test_sync_from_peers(self):
+        sync, network = self.make_sync([b"A", b"B"])
+        self.assertTrue(sync.start(b"A", len(self.remote.chain)))
+        network.deliver()
+        self.assertFalse(sync.active)
+        self.assertEqual(self.local.last_hash, self.remote.last_hash)
+
+    def test_sync_from_forked_chain(self):
+        # Same first 6 blocks, then 3 blocks only the local chain has
+        self.assertTrue(self.local.extend_chain(self.remote.chain[1:6]))
+        grow(self.local, 3, "local")
+        sync, network = self.make_sync([b"A"])
+        self.assertTrue(sync.start(b"A", len(self.remote.chain)))
+        network.deliver()
+        self.assertFalse(sync.active)
+        self.assertEqual(self.local.last_hash, self.remote.last_hash)
+        self.assertEqual({t.file_hash for t in self.local.pending_transactions},
+                         {"local-0", "local-1", "local-2"})
+        self.assertTrue(self.local.verify_chain())
+
+    def test_recovered_peer_is_used_again(self):
+        sync, network = self.make_sync([b"A", b"B"])
+        for _ in range(sync.MAX_FAILURES):
+            sync._stats(b"A").fail()
+
+        # Failing peer gets no work
+        sync.start(b"B", len(self.remote.chain))
+        network.outbox = [m for m in network.outbox if m[1] == "get_headers"]
+        network.deliver()
+        self.assertEqual(sync._stats(b"A").blocks, 0)
+        self.assertEqual(self.local.last_hash, self.remote.last_hash)
+
+        # After the retry window it is asked again, valid responses lower its failures
+        grow(self.remote, 8, "more")
+        sync.RETRY_AFTER = 0
+        network.silent.add(b"B")
+        self.assertTrue(sync.start(b"A", len(self.remote.chain)))
+        network.deliver()
+        self.assertEqual(self.local.last_hash, self.remote.last_hash)
+        self.assertEqual(sync._stats(b"A").blocks, 8)
+        self.assertLess(sync._stats(b"A").failures, sync.MAX_FAILURES)
+
+    def test_success_forgives_failures(self):
+        sync, network = self.make_sync([b"A"])
+        sync._stats(b"A").fail()
+        sync._stats(b"A").fail()
+        sync.start(b"A", len(self.remote.chain))
+        network.deliver()
+        self.assertEqual(self.local.last_hash, self.remote.last_hash)
+        self.assertEqual(sync._stats(b"A").failures, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
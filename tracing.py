@@ -0,0 +1,137 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer: "Tracer", name: str, args: Dict):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.record(self.name, self.start, time.perf_counter(), **self.args)
+        return False
+
+
+class Tracer:
+    """
+    Records timed spans of operations in a ring buffer, with the thread they ran on.
+    Spans are dumped in the Chrome trace format, viewable in chrome://tracing or Perfetto.
+    Disabled by default, then spans cost one attribute check.
+    """
+
+    def __init__(self, capacity: int = 100000, enabled: bool = False):
+        """
+        Tracer class constructor
+        :param capacity: Number of most recent spans kept
+        :param enabled: Whether spans are recorded
+        """
+
+        self.enabled = enabled
+        self.events = deque(maxlen=capacity)
+        self._threads = {}  # Thread ID -> thread name
+        self._origin = time.perf_counter()
+
+    def record(self, name: str, start: float, end: float, **args):
+        """
+        Records a finished span
+        :param name: Operation name
+        :param start: time.perf_counter() at the start
+        :param end: time.perf_counter() at the end
+        :param args: Details shown with the span
+        """
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        self._threads[thread.ident] = thread.name
+        # deque.append is atomic, no lock needed
+        self.events.append((name, start, end, thread.ident, args))
+
+    def span(self, name: str, **args):
+        """
+        Returns context manager recording a span around its block
+        :param name: Operation name
+        :param args: Details shown with the span
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def trace(self, name: str = None) -> Callable:
+        """
+        Decorator recording a span around every call of a function
+        :param name: Operation name, the function's qualified name by default
+        """
+        def decorator(function):
+            span_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.record(span_name, start, time.perf_counter())
+            return wrapper
+        return decorator
+
+    def clear(self):
+        """
+        Drops recorded spans
+        """
+        self.events.clear()
+
+    def to_chrome(self) -> Dict:
+        """
+        Returns recorded spans as a Chrome trace dictionary
+        """
+        pid = os.getpid()
+        events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+                  for tid, name in list(self._threads.items())]
+        for name, start, end, tid, args in list(self.events):
+            events.append({
+                "name": name,
+                "ph": "X",
+                "ts": (start - self._origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": pid,
+                "tid": tid,
+                "args": {k: str(v) for k, v in args.items()}
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path: str) -> int:
+        """
+        Writes recorded spans to a Chrome trace JSON file, returns number of spans
+        :param path: Output file path
+        """
+        trace = self.to_chrome()
+        with open(path, "w") as f:
+            json.dump(trace, f)
+        return sum(1 for e in trace["traceEvents"] if e["ph"] == "X")
+
+
+# Enabled with FIRMWARECHAIN_TRACE=1 or the console trace command
+tracer = Tracer(enabled=os.environ.get("FIRMWARECHAIN_TRACE", "") not in ("", "0"))
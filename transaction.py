@@ -1,35 +1,51 @@
+import hashlib
 import json
 
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends.openssl.rsa import (_RSAPrivateKey,
                                                       _RSAPublicKey)
-from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicNumbers
+
+from keys import key_manager
+import metrics
+from signature_cache import signature_cache
+from trusted_keys import trusted_keys
 
 
 class Transaction:
     """
     Transaction class containing update data.
     """
+    # Fields serialized by toJSON, assigning any of them clears the cached digest
+    DIGEST_FIELDS = frozenset(("public_key", "version", "file_hash", "filename", "signature",
+                               "manifest"))
 
-    def __init__(self, public_key: _RSAPublicKey, version: str, file_hash: str, filename: str):
+    def __init__(self, public_key: _RSAPublicKey, version: str, file_hash: str, filename: str,
+                 manifest: str = None):
         """
         Transaction class constructor
         :param public_key: Author's public key
         :param version: Software update version
         :param file_hash: SHA256 hash of update file
         :param filename: Name of update file
+        :param manifest: Hash of the chunk manifest of update file in the blob store, optional
         """
 
         self.public_key = public_key
         self.version = version
         self.file_hash = file_hash
         self.filename = filename
+        self.manifest = manifest
+
+    def __setattr__(self, name, value):
+        if name in self.DIGEST_FIELDS:
+            self.__dict__.pop("_digest", None)
+        super().__setattr__(name, value)
 
     def sign(self, key: _RSAPrivateKey):
         """
-        Signs transaction with given key.
+        Signs transaction with given key, the new signature clears the cached digest.
         :param key: Master Private Key
         """
 
@@ -45,6 +61,20 @@ class Transaction:
     def verify(self) -> bool:
         """
         Verifies signed transaction using a public key.
+        Results are cached by transaction digest, so each transaction is verified once.
+        """
+
+        digest = self.digest
+        result = signature_cache.get(digest)
+        if result is None:
+            with metrics.verify_seconds.time(kind="signature"):
+                result = self._verify_signature()
+            signature_cache.put(digest, result)
+        return result
+
+    def _verify_signature(self) -> bool:
+        """
+        Checks the RSA signature, bypassing the cache
         """
 
         try:
@@ -64,39 +94,47 @@ class Transaction:
     @property
     def representation(self) -> bytes:
         """
-        Returns bytes representation of transaction
+        Returns bytes representation of transaction, the signed data
         """
-        key = self.public_key.public_bytes(
-            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
-        return b"%s%s%s%s" % (key, self.version.encode(), self.file_hash.encode(), self.filename.encode())
+        key = key_manager.public_bytes(self.public_key)
+        fields = (key, self.version.encode(), self.file_hash.encode(), self.filename.encode())
+        if self.manifest is None:
+            # Format of transactions without a manifest, their signatures stay valid
+            return b"".join(fields)
+        # Tagged and length prefixed, so no field can absorb the manifest or be shifted into it.
+        # PEM keys start with "-", the tag never matches the format above.
+        return b"tx2" + b"".join(b"%d:%s" % (len(f), f) for f in fields + (self.manifest.encode(),))
+
+    @property
+    def digest(self) -> str:
+        """
+        Returns sha256 hash of the serialized transaction, signature included.
+        Computed once, recomputed after any of DIGEST_FIELDS is assigned.
+        """
+        digest = self.__dict__.get("_digest")
+        if digest is None:
+            digest = hashlib.sha256(self.toJSON().encode()).hexdigest()
+            self._digest = digest
+        return digest
 
     def numerize_public_key(self) -> str:
         """
         Returns public key in a numeric, human readable format
         """
-        n = self.public_key.public_numbers().n
-        e = self.public_key.public_numbers().e
-        return f"{n}|{e}"
+        return key_manager.numerize(self.public_key)
 
     @classmethod
     def denumerize_public_key(self, key_numeric: str) -> _RSAPublicKey:
         """
         Returns public key from a numeric format
         """
-        n, e = key_numeric.split('|')
-        return RSAPublicNumbers(int(e), int(n)).public_key()
+        return key_manager.denumerize(key_numeric)
 
-    def is_author_trusted(self):
+    def is_author_trusted(self) -> bool:
         """
         Chcecks if author's public key is on the trusted list
         """
-        credentials = self.numerize_public_key()
-
-        with open("trusted_keys.json", "r") as file:
-            if credentials in file.read().splitlines():
-                return True
-            else:
-                return False
+        return self.public_key in trusted_keys
 
     @property
     def is_signed(self):
@@ -116,13 +154,17 @@ class Transaction:
             signature = self.signature.hex()
         except AttributeError:
             signature = None
-        return json.dumps({
+        data = {
             "public_key": self.numerize_public_key(),
             "version": self.version,
             "file_hash": self.file_hash,
             "filename": self.filename,
             "signature": signature
-        })
+        }
+        # Left out when missing, so digests of older transactions don't change
+        if self.manifest is not None:
+            data["manifest"] = self.manifest
+        return json.dumps(data)
 
     def __eq__(self, other):
         """
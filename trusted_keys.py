@@ -0,0 +1,131 @@
+import json
+import os
+import threading
+import time
+from typing import FrozenSet, Iterable
+
+from cryptography.hazmat.backends.openssl.rsa import _RSAPublicKey
+
+from keys import key_manager
+
+
+class TrustedKeys:
+    """
+    Registry of public keys allowed to author transactions, kept as a set of key fingerprints.
+    The file is read once and reloaded when it changes. It holds one key per line or
+    a JSON list, each key as a fingerprint or in the numeric "n|e" format.
+    Nothing is enforced while the file doesn't exist.
+    """
+    RELOAD_INTERVAL = 5.0  # Minimum seconds between file change checks
+
+    def __init__(self, path: str = "trusted_keys.json"):
+        """
+        TrustedKeys class constructor
+        :param path: Path of the trusted keys file
+        """
+
+        self.path = path
+        self._fingerprints = frozenset()  # type: FrozenSet[str]
+        self._exists = False
+        self._mtime = None
+        self._checked = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def parse(data: str) -> FrozenSet[str]:
+        """
+        Returns fingerprints of keys listed in trusted keys file contents
+        :param data: File contents
+        """
+        try:
+            entries = json.loads(data)
+        except ValueError:
+            entries = data.splitlines()
+        if not isinstance(entries, list):
+            raise ValueError("Trusted keys must be a list")
+
+        fingerprints = set()
+        for entry in entries:
+            if not isinstance(entry, str):
+                raise ValueError(f"Not a key: {entry!r}")
+            entry = entry.strip()
+            if not entry:
+                continue
+            if '|' in entry:
+                entry = key_manager.fingerprint(key_manager.denumerize(entry))
+            fingerprints.add(entry.lower())
+        return frozenset(fingerprints)
+
+    def _load(self):
+        """
+        Reloads the file if it changed, checked at most every RELOAD_INTERVAL seconds
+        """
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < self.RELOAD_INTERVAL:
+            return
+        with self._lock:
+            self._checked = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                self._exists, self._mtime, self._fingerprints = False, None, frozenset()
+                return
+            if self._exists and mtime == self._mtime:
+                return
+            self.reload()
+
+    def reload(self):
+        """
+        Reads the file from disk, an unreadable file trusts nobody
+        """
+        with self._lock:
+            self._checked = time.monotonic()
+            try:
+                self._mtime = os.stat(self.path).st_mtime_ns
+                with open(self.path, "r") as file:
+                    data = file.read()
+            except FileNotFoundError:
+                self._exists, self._mtime, self._fingerprints = False, None, frozenset()
+                return
+            self._exists = True
+            try:
+                self._fingerprints = self.parse(data)
+            except ValueError as e:
+                print(f"Invalid {self.path}: {e}")
+                self._fingerprints = frozenset()
+
+    @property
+    def enabled(self) -> bool:
+        """
+        Returns True if the trusted keys file exists and is enforced
+        """
+        self._load()
+        return self._exists
+
+    def __contains__(self, key: _RSAPublicKey) -> bool:
+        self._load()
+        return key_manager.fingerprint(key) in self._fingerprints
+
+    def __len__(self):
+        self._load()
+        return len(self._fingerprints)
+
+    def admits(self, key: _RSAPublicKey) -> bool:
+        """
+        Returns True if the author may add transactions:
+        the key is trusted or the registry isn't enforced
+        :param key: Author's public key
+        """
+        self._load()
+        return not self._exists or key_manager.fingerprint(key) in self._fingerprints
+
+    def admits_all(self, keys: Iterable[_RSAPublicKey]) -> bool:
+        """
+        Returns True if all authors may add transactions
+        :param keys: Authors' public keys
+        """
+        return all(self.admits(key) for key in keys)
+
+
+# Registry shared by transactions and the blockchain
+trusted_keys = TrustedKeys()
@@ -0,0 +1,98 @@
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterable, List
+
+from transaction import Transaction
+
+
+def _verify_chunk(transactions: List[Transaction], failed: threading.Event) -> bool:
+    """
+    Verifies transactions one by one, stops early if another chunk failed
+    :param transactions: Transactions to verify
+    :param failed: Event set by the first failing chunk
+    """
+    for transaction in transactions:
+        if failed.is_set():
+            return False
+        if not transaction.verify():
+            failed.set()
+            return False
+    return True
+
+
+class BatchVerifier:
+    """
+    Verifies transaction signatures on a thread pool.
+    OpenSSL releases the GIL, so signatures are checked on all cores.
+    """
+    CHUNK_SIZE = 16  # Transactions verified by a single task
+
+    def __init__(self, workers: int = None):
+        """
+        BatchVerifier class constructor
+        :param workers: Number of threads, defaults to CPU count
+        """
+
+        self.workers = workers or os.cpu_count() or 1
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        """
+        Returns thread pool, starting it on first use
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="verifier")
+            return self._pool
+
+    def verify(self, transactions: Iterable[Transaction]) -> bool:
+        """
+        Returns True if all transactions are valid.
+        Stops at the first invalid one.
+        :param transactions: Transactions to verify
+        """
+
+        transactions = list(transactions)
+        failed = threading.Event()
+        if self.workers == 1 or len(transactions) <= self.CHUNK_SIZE:
+            return _verify_chunk(transactions, failed)
+
+        pending = {
+            self.pool.submit(_verify_chunk, transactions[i:i + self.CHUNK_SIZE], failed)
+            for i in range(0, len(transactions), self.CHUNK_SIZE)
+        }
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                if not all(future.result() for future in done):
+                    return False
+        finally:
+            failed.set()
+            for future in pending:
+                future.cancel()
+        return True
+
+    def verify_blocks(self, blocks: Iterable) -> bool:
+        """
+        Verifies transactions of many blocks as one batch
+        :param blocks: Block objects
+        """
+
+        return self.verify(t for block in blocks for t in block.transactions)
+
+    def close(self):
+        """
+        Shuts the thread pool down
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+
+# Verifier shared by blocks and the blockchain
+batch_verifier = BatchVerifier()